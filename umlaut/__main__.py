@@ -0,0 +1,22 @@
+import argparse
+
+from umlaut.spool import replay
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='umlaut')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    replay_parser = subparsers.add_parser('replay', help='upload a local spool to an umlaut server')
+    replay_parser.add_argument('spool', help='path to a .sqlite spool file')
+    replay_parser.add_argument('--host', default='localhost')
+    replay_parser.add_argument('--port', type=int, default=5000)
+    replay_parser.add_argument('--batch-size', type=int, default=500)
+
+    args = parser.parse_args()
+    if args.command == 'replay':
+        replay(args.spool, host=args.host, port=args.port, batch_size=args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
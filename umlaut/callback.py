@@ -1,5 +1,7 @@
+import contextlib
 import numpy as np
 import json
+import requests
 import tensorflow as tf
 import tensorflow.keras.backend as K
 import traceback as tb
@@ -7,11 +9,54 @@ import types
 from termcolor import colored
 
 from umlaut.client import UmlautClient
-from umlaut.heuristics import run_epoch_heuristics
-from umlaut.heuristics import run_pretrain_heuristics
+from umlaut.client import default_session_name
+from umlaut.client import make_metrics_dict
+from umlaut.client import serialize_errors
+from umlaut.spool import UmlautSpool
+from umlaut.spool import default_spool_path
+from umlaut.heuristics import HeuristicScheduler
+from umlaut.overhead import OverheadTracker
+from umlaut.overhead import make_overhead_metrics_dict
+from umlaut.overhead import print_overhead_report
+from umlaut.source import index_source_module
+from umlaut.stats import AccumulatorGroup
+from umlaut.stats import ActivationMonitor
+from umlaut.stats import ActivationSketch
+from umlaut.stats import GradientStatsAccumulator
+from umlaut.stats import InputStatsAccumulator
+from umlaut.stats import OutputStatsAccumulator
+from umlaut.stats import compute_batches_stats
+from umlaut.stats import compute_input_stats
+from umlaut.stats import make_spec_input_stats
 
 class UmlautCallback(tf.keras.callbacks.Callback):
-    def __init__(self, model, session_name=None, host='localhost', offline=False):
+    def __init__(
+        self,
+        model,
+        session_name=None,
+        host='localhost',
+        offline=False,
+        max_queue_size=64,
+        queue_policy='drop',
+        spool_path=None,
+        input_sample_every=1,
+        input_sample_fraction=None,
+        capture_during_eval=False,
+        detach_after_epochs=None,
+        capture_output=False,
+        max_heuristic_cost='expensive',
+        report_overhead=False,
+        overhead_budget=None,
+        batch_check_every=20,
+        on_nan=None,
+        monitor_gradients=False,
+        gradient_sample_every=10,
+        monitor_activations=False,
+        activation_sample_every=10,
+        dataset=None,
+        dataset_batches=2,
+        capture_input=None,
+    ):
 
         #TODO need a case where we can't extract the frame, set to None
         self._source_module_path = tb.extract_stack()[-2].filename
@@ -21,56 +66,378 @@ class UmlautCallback(tf.keras.callbacks.Callback):
         self.source_module = {
             'path': self._source_module_path,
             'contents': self._source_module_contents,
+            'index': index_source_module(self._source_module_contents),
         }
 
         self.tf_version = int(tf.__version__[0])  # 1 or 2
 
-        # set up model shim
+        # under a distribution strategy, statistics are accumulated per
+        # replica and reduced on device. every worker captures and fetches
+        # them, but only the chief runs heuristics and reports.
+        self.strategy = getattr(model, 'distribute_strategy', None)
+        self.is_chief = _is_chief(self.strategy)
+        self.heuristic_scheduler = HeuristicScheduler(max_cost=max_heuristic_cost)
+
+        # time umlaut adds to each epoch, always sent to the server. printed
+        # when report_overhead is set, or when it exceeds overhead_budget
+        # (a fraction of the epoch).
+        self.overhead = OverheadTracker()
+        self.report_overhead = report_overhead
+        self.overhead_budget = overhead_budget
+
+        # batch heuristics run every batch_check_every training steps. when
+        # the loss turns NaN or Inf, on_nan may be 'stop' to end training, or
+        # 'restore' to also roll back to the weights of the last good epoch.
+        if on_nan not in (None, 'stop', 'restore'):
+            raise ValueError(f'on_nan must be None, "stop" or "restore", got {on_nan}')
+        self.batch_check_every = batch_check_every
+        self.on_nan = on_nan
+        self._epoch = 0
+        self._nan_reported = False
+        self._last_good_weights = None
+        # take logs as tensors, so keras doesn't sync to numpy on every batch
+        self._supports_tf_logs = True
+
+        # set up model shim. inputs are captured every input_sample_every
+        # training steps, optionally only a random input_sample_fraction of
+        # the batch rows, and the shim is switched off after
+        # detach_after_epochs epochs.
         self.model = model
-        self.input_node = tf.Variable(
-            0.,
-            shape=tf.TensorShape(None),
-            validate_shape=False,
-            trainable=False,
-        )
-        self.output_node = tf.Variable(
-            0.,
-            shape=tf.TensorShape(None),
-            validate_shape=False,
-            trainable=False,
-        )
+        # a tf.data dataset, or the numpy array of inputs passed to fit, is
+        # checked once before training instead, so by default the shim then
+        # doesn't capture inputs at all.
+        self.dataset = dataset
+        self.dataset_batches = dataset_batches
+        self.capture_input = capture_input if capture_input is not None else dataset is None
+        self.input_stats = InputStatsAccumulator(strategy=self.strategy)
+        self.input_sample_every = input_sample_every
+        self.input_sample_fraction = input_sample_fraction
+        self.capture_during_eval = capture_during_eval
+        self.detach_after_epochs = detach_after_epochs
+        with _strategy_scope(self.strategy):
+            # every replica counts the same steps, so any one copy will do
+            self._shim_step = tf.Variable(
+                0, dtype=tf.int64, trainable=False,
+                synchronization=tf.VariableSynchronization.ON_READ,
+                aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA,
+            )
+            self._shim_enabled = tf.Variable(True, trainable=False)
+            self._shim_seconds = tf.Variable(
+                0., dtype=tf.float64, trainable=False,
+                synchronization=tf.VariableSynchronization.ON_READ,
+                aggregation=tf.VariableAggregation.MEAN,
+            )
+        self._original_call = model.call
+        self._tracing_capture = False  # set while a captured model call is traced
+        # output summaries are opt-in, no built-in heuristic needs them
+        self.output_stats = None
+        if capture_output:
+            self.output_stats = OutputStatsAccumulator(
+                num_classes=_get_num_classes(model),
+                outputs_are_probabilities=_outputs_are_probabilities(model),
+                strategy=self.strategy,
+            )
         self.register_model(self.model)
 
+        # activation sketches are opt-in. monitor_activations is True for
+        # every relu, sigmoid and tanh layer, or a list of layer names.
+        self.activation_sample_every = activation_sample_every
+        self.activation_monitor = None
+        if monitor_activations:
+            self.activation_monitor = self.register_activation_monitor(monitor_activations)
+
+        # gradient statistics are opt-in, sampled every gradient_sample_every
+        # steps. the optimizer is only wrapped on train begin, once it exists.
+        self.monitor_gradients = monitor_gradients
+        self.gradient_sample_every = gradient_sample_every
+        self.gradient_stats = None
+        # every accumulator is fetched together at epoch end, set on train begin
+        self.epoch_stats = None
+
+        # set up local spool, written when offline or the server is unreachable.
+        # workers share the chief's session name, they never write to it.
+        session_name = session_name or default_session_name()
+        if _is_multi_worker(self.strategy):
+            session_name = _broadcast_from_chief(self.strategy, session_name, self.is_chief)
+        self.session_name = session_name
+        self.umlaut_spool = UmlautSpool(
+            spool_path or default_spool_path(session_name),
+            session_name,
+        )
+
         # set up umlaut client
         self.umlaut_client = None
-        if not offline:
+        if not offline and self.is_chief:
             self.host = host
             if not self.host.startswith('http'):
                 self.host = 'http://' + self.host
-            self.umlaut_client = UmlautClient(session_name, host)
+            try:
+                self.umlaut_client = UmlautClient(
+                    session_name,
+                    host,
+                    max_queue_size=max_queue_size,
+                    queue_policy=queue_policy,
+                    spool=self.umlaut_spool,
+                )
+                # updates spooled from now on belong to this session
+                self.umlaut_spool.set_session(self.umlaut_client.session_id, self.umlaut_client.host)
+            except requests.RequestException as e:
+                print(colored(f'Umlaut could not reach the server ({e}), writing to {self.umlaut_spool.path}', 'yellow'))
 
 
     def on_train_begin(self, logs=None):
-        errors = run_pretrain_heuristics(self.model, self.source_module)
+        if self.on_nan == 'restore':
+            # so a NaN in the first epoch has weights to go back to
+            self._last_good_weights = self.model.get_weights()
+        if self.monitor_gradients and self.gradient_stats is None:
+            self.gradient_stats = GradientStatsAccumulator(
+                self.model.trainable_variables,
+                self.gradient_sample_every,
+                strategy=self.strategy,
+            )
+            self.gradient_stats.wrap_optimizer(self.model.optimizer)
+        if self.epoch_stats is None:
+            self.epoch_stats = AccumulatorGroup(
+                [
+                    self.input_stats if self.capture_input else None,
+                    self.output_stats,
+                    self.gradient_stats,
+                    self.activation_monitor,
+                ],
+                strategy=self.strategy,
+            )
+
+        if not self.is_chief:
+            return
+        errors = self.heuristic_scheduler.run(
+            'once',
+            model=self.model,
+            source_module=self.source_module,
+        )
+        if self.dataset is not None:
+            errors += self._inspect_dataset()
+        if errors:
+            print(colored('Umlaut results:', 'magenta'))
+            print(colored(errors, 'red'))
+            self._send_errors(errors)
+
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = epoch
+        self._nan_reported = False
+        self.overhead.start_epoch()
+        K.set_value(self._shim_seconds, 0.)
+        self.input_stats.reset()
+        if self.output_stats:
+            self.output_stats.reset()
+        if self.gradient_stats:
+            self.gradient_stats.reset()
+        if self.activation_monitor:
+            self.activation_monitor.reset()
+
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self._nan_reported or not logs or 'loss' not in logs or batch % self.batch_check_every:
+            return
+        with self.overhead.timed('batch'):
+            # in tf2 the batch loss is the running mean over the epoch, so once
+            # it is NaN it stays NaN, and checking every few steps doesn't miss it.
+            loss_is_finite = np.isfinite(float(logs['loss']))
+            # only worth the transfer once something went wrong. the loss is the
+            # same on every worker, so they all join the reduction.
+            input_stats = None if loss_is_finite else self.input_stats.result()
+            errors = []
+            if self.is_chief:
+                errors = self.heuristic_scheduler.run(
+                    'batch',
+                    batch,
+                    epoch=self._epoch,
+                    batch=batch,
+                    logs=logs,
+                    input_stats=input_stats,
+                )
         if errors:
+            print()
             print(colored('Umlaut results:', 'magenta'))
             print(colored(errors, 'red'))
-            if self.umlaut_client:
-                self.umlaut_client.send_errors(errors)
+            self._send_errors(errors)
+        if not loss_is_finite:
+            self._nan_reported = True
+            self._handle_nan_loss()
 
 
     def on_epoch_end(self, batch, logs=None):
-        if self.umlaut_client:
-            self.umlaut_client.send_logs_to_server(batch, logs)
+        logs = _logs_to_numpy(logs)
+        if self.on_nan == 'restore' and np.isfinite(logs.get('loss', np.nan)):
+            self._last_good_weights = self.model.get_weights()
+        self._send_logs(batch, logs)
+        if self.detach_after_epochs is not None and batch + 1 >= self.detach_after_epochs:
+            self.detach_model()
+
+        with self.overhead.timed('transfer'):
+            input_stats, output_stats, gradient_stats, activation_stats = self.epoch_stats.results()
+            self.overhead.add('shim', K.get_value(self._shim_seconds))
 
-        model_input = K.eval(self.input_node)
-        errors = run_epoch_heuristics(batch, self.model, logs, model_input, self.source_module)
+        if not self.is_chief:
+            return
+        errors = self.heuristic_scheduler.run(
+            'epoch',
+            batch,
+            epoch=batch,
+            model=self.model,
+            optimizer=self.model.optimizer,
+            logs=logs,
+            input_stats=input_stats,
+            output_stats=output_stats,
+            gradient_stats=gradient_stats,
+            activation_stats=activation_stats,
+            source_module=self.source_module,
+        )
+        self.overhead.heuristic_seconds.update(self.heuristic_scheduler.last_timings)
+        self.overhead.add('heuristics', sum(self.heuristic_scheduler.last_timings.values()))
         if errors:
             print()
             print(colored('Umlaut results:', 'magenta'))
             print(colored(errors, 'red'))
-            if self.umlaut_client:
-                self.umlaut_client.send_errors(errors)
+            self._send_errors(errors)
+
+        self._report_overhead(batch)
+
+
+    def on_train_end(self, logs=None):
+        if self.umlaut_client:
+            self.umlaut_client.flush()
+        self.umlaut_spool.close()
+
+
+    def _report_overhead(self, epoch):
+        if self.umlaut_client:
+            self.overhead.add('http', self.umlaut_client.pop_http_seconds())
+        report = self.overhead.end_epoch()
+        self._send_metrics(make_overhead_metrics_dict(epoch, report))
+        over_budget = self.overhead_budget is not None and report['fractions']['total'] > self.overhead_budget
+        if self.report_overhead or over_budget:
+            print_overhead_report(epoch, report, self.overhead_budget)
+
+
+    def _send_logs(self, batch, logs):
+        metrics_dict = make_metrics_dict(batch, logs)
+        if metrics_dict:
+            self._send_metrics(metrics_dict)
+
+
+    def _send_metrics(self, metrics_dict):
+        if not self.is_chief:
+            return
+        if self.umlaut_client:
+            self.umlaut_client.send_metrics(metrics_dict)
+        else:
+            self.umlaut_spool.write(metrics=[metrics_dict])
+
+
+    def _send_errors(self, errors):
+        if not self.is_chief:
+            return
+        if self.umlaut_client:
+            self.umlaut_client.send_errors(errors)
+        else:
+            self.umlaut_spool.write(errors=serialize_errors(errors))
+
+
+    def _inspect_dataset(self):
+        '''Runs the input heuristics on the dataset before training.
+
+        dtype and shape come from the element_spec without reading any
+        data. Values come from the first dataset_batches batches. A numpy
+        array is already in memory, so all of it is reduced, in one pass.
+        '''
+        if isinstance(self.dataset, np.ndarray):
+            input_stats = compute_input_stats(self.dataset)
+        else:
+            input_stats = self._dataset_input_stats()
+        # without logs or the model, only the input heuristics have their inputs
+        return self.heuristic_scheduler.run(
+            'epoch',
+            epoch=0,
+            input_stats=input_stats,
+            source_module=self.source_module,
+        )
+
+
+    def _dataset_input_stats(self):
+        x_spec = _get_input_spec(self.dataset.element_spec)
+        # e.g. from_generator without output shapes has no known rank
+        shape = tuple(x_spec.shape.as_list()) if x_spec.shape.rank is not None else None
+        input_stats = make_spec_input_stats(x_spec.dtype, shape)
+        if self.dataset_batches and tf.executing_eagerly():
+            batches = [
+                _get_input(element).numpy()
+                for element in self.dataset.take(self.dataset_batches)
+            ]
+            input_stats = compute_batches_stats(batches, x_spec.dtype, shape) or input_stats
+        return input_stats
+
+
+    def _handle_nan_loss(self):
+        if self.on_nan is None:
+            return
+        if self.on_nan == 'restore' and self._last_good_weights is not None:
+            print(colored(f'Umlaut restored the weights from before epoch {self._epoch}.', 'yellow'))
+            self.model.set_weights(self._last_good_weights)
+        print(colored('Umlaut stopped training after the loss became NaN.', 'yellow'))
+        self.model.stop_training = True
+
+
+    def detach_model(self):
+        '''Stops capturing inputs and restores the model's original call.
+
+        Functions already traced with the shim keep it, but it is
+        disabled in graph so it no longer does any work.
+        '''
+        K.set_value(self._shim_enabled, False)
+        self.model.call = self._original_call
+
+
+    def _should_capture(self, training):
+        if self.capture_during_eval or self.tf_version == 1:
+            # tf1 passes the learning phase implicitly, so always capture
+            return True
+        # fit passes training=True, evaluate and predict pass False or None.
+        return training is True or tf.is_tensor(training)
+
+
+    def _sample_step(self):
+        '''Returns a bool tensor, true on the training steps which are sampled.'''
+        step = self._shim_step.assign_add(1)
+        return tf.logical_and(
+            self._shim_enabled,
+            tf.equal(step % self.input_sample_every, 0),
+        )
+
+
+    def _sample_rows(self, x):
+        if self.input_sample_fraction is None:
+            return x
+        rows = tf.random.uniform(tf.shape(x)[:1]) < self.input_sample_fraction
+        return tf.boolean_mask(x, rows)
+
+
+    def _capture(self, sampled, make_update):
+        '''Returns an op which runs make_update() only when sampled.
+
+        The time spent is added to _shim_seconds. Timestamps are taken when
+        the ops run, so this is approximate for asynchronous devices.
+        '''
+        def update():
+            start = tf.timestamp()
+            with tf.control_dependencies([start]):
+                update_op = make_update()
+            with tf.control_dependencies([update_op]):
+                elapsed = tf.timestamp() - start
+            with tf.control_dependencies([self._shim_seconds.assign_add(elapsed)]):
+                return tf.constant(True)
+
+        return tf.cond(sampled, update, lambda: tf.constant(False))
 
 
     def register_model(self, model):
@@ -82,25 +449,145 @@ class UmlautCallback(tf.keras.callbacks.Callback):
         current_call = model.call
 
         def new_call(wrap_instance, x, *args, **kwargs):  # self here is the model, not the callback
-            input_assign = self.input_node.assign(tf.cast(x, K.floatx()))  # pylint: disable=no-member
-            with tf.control_dependencies([input_assign]):
-                out = current_call(x, *args, **kwargs)
-            output_assign = self.output_node.assign(tf.cast(out, K.floatx()))  # pylint: disable=no-member
-            with tf.control_dependencies([output_assign]):
-                out = tf.identity(out)
-            return out
+            nothing_to_capture = not (self.capture_input or self.output_stats or self.activation_monitor)
+            if nothing_to_capture or not self._should_capture(kwargs.get('training', args[0] if args else None)):
+                return current_call(x, *args, **kwargs)
 
-        if tf.__version__.startswith('1'):
-            def v1_compat_call(wrap_instance, x, *args, **kwargs):
-                input_assign = tf.assign(self.input_node, tf.cast(x, K.floatx()), validate_shape=False)  # pylint: disable=no-member
-                with tf.control_dependencies([input_assign]):
+            sampled = self._sample_step()
+            input_updates = []
+            if self.capture_input:
+                input_updates.append(self._capture(sampled, lambda: self.input_stats.update(self._sample_rows(x))))
+            with tf.control_dependencies(input_updates):
+                self._tracing_capture = True
+                try:
                     out = current_call(x, *args, **kwargs)
-                output_assign = tf.assign(self.output_node, tf.cast(out, K.floatx()), validate_shape=False)  # pylint: disable=no-member
-                with tf.control_dependencies([output_assign]):
+                finally:
+                    self._tracing_capture = False
+            if self.output_stats and tf.is_tensor(out):
+                output_update = self._capture(sampled, lambda: self.output_stats.update(out))
+                with tf.control_dependencies([output_update]):
                     out = tf.identity(out)
+            return out
+
+        model.call = types.MethodType(new_call, model)
+
+
+    def register_activation_monitor(self, layer_names=True):
+        '''Wraps the selected layers' calls to sketch their activations.
+
+        Layers are sampled every activation_sample_every steps of the model
+        shim, and only while the model call itself is being captured.
+        '''
+        sketches = []
+        for layer in self.model.layers:
+            activation = _get_activation_name(layer)
+            if layer_names is True:
+                if activation not in ('relu', 'sigmoid', 'tanh'):
+                    continue
+            elif layer.name not in layer_names:
+                continue
+            try:
+                units = layer.output_shape[-1]
+            except (AttributeError, TypeError):
+                units = None
+            if not units:
+                print(colored(f'Umlaut can\'t monitor layer {layer.name} before the model is built, skipping it.', 'yellow'))
+                continue
+            sketch = ActivationSketch(layer.name, units, activation, strategy=self.strategy)
+            self._wrap_layer(layer, sketch)
+            sketches.append(sketch)
+        return ActivationMonitor(sketches, strategy=self.strategy) if sketches else None
+
+
+    def _wrap_layer(self, layer, sketch):
+        current_call = layer.call
+
+        def new_call(wrap_instance, inputs, *args, **kwargs):  # self here is the layer, not the callback
+            out = current_call(inputs, *args, **kwargs)
+            if not self._tracing_capture or not tf.is_tensor(out):
                 return out
+            sampled = tf.logical_and(
+                self._shim_enabled,
+                tf.equal(self._shim_step % self.activation_sample_every, 0),
+            )
+            with tf.control_dependencies([self._capture(sampled, lambda: sketch.update(out))]):
+                return tf.identity(out)
+
+        layer.call = types.MethodType(new_call, layer)
+
+
+def _logs_to_numpy(logs):
+    return {k: v.numpy() if hasattr(v, 'numpy') else v for k, v in (logs or {}).items()}
+
+
+def _get_input(element):
+    '''the model input of a dataset element, which may be (x, y[, sample_weight])'''
+    if isinstance(element, tuple):
+        element = element[0]
+    return tf.nest.flatten(element)[0]
+
+
+def _get_input_spec(element_spec):
+    if isinstance(element_spec, tuple):
+        element_spec = element_spec[0]
+    return tf.nest.flatten(element_spec)[0]
+
+
+def _get_activation_name(layer):
+    if isinstance(layer, tf.keras.layers.ReLU):
+        return 'relu'
+    activation = layer.get_config().get('activation')
+    return activation if isinstance(activation, str) else None
+
+
+def _strategy_scope(strategy):
+    return strategy.scope() if strategy is not None else contextlib.nullcontext()
+
+
+def _is_multi_worker(strategy):
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    return resolver is not None and bool(resolver.cluster_spec().as_dict())
+
+
+def _is_chief(strategy):
+    '''whether this process reports, the chief or else worker 0 of the cluster.'''
+    if not _is_multi_worker(strategy):
+        return True
+    resolver = strategy.cluster_resolver
+    if resolver.task_type == 'chief':
+        return True
+    has_chief = 'chief' in resolver.cluster_spec().as_dict()
+    return not has_chief and resolver.task_type == 'worker' and resolver.task_id == 0
+
+
+@tf.function
+def _all_reduce_sum(x):
+    '''sums x across replicas, traced once per strategy and shape'''
+    return tf.distribute.get_replica_context().all_reduce(tf.distribute.ReduceOp.SUM, x)
+
+
+def _broadcast_from_chief(strategy, name, is_chief, max_length=256):
+    '''All-reduces the chief's session name, so every worker gets the same one.'''
+    codes = np.zeros(max_length, dtype=np.int32)
+    if is_chief:
+        encoded = list(name.encode()[:max_length])
+        codes[:len(encoded)] = encoded
+
+    result = strategy.run(_all_reduce_sum, args=(tf.constant(codes),))
+    result = strategy.experimental_local_results(result)[0].numpy()
+    # each of the chief's local replicas contributed a copy
+    result //= len(strategy.extended.worker_devices)
+    return bytes(int(c) for c in result if c).decode()
+
+
+def _outputs_are_probabilities(model):
+    '''whether the model ends in a softmax, as a layer or a layer's activation'''
+    last_layer = model.layers[-1]
+    return isinstance(last_layer, tf.keras.layers.Softmax) or _get_activation_name(last_layer) == 'softmax'
 
-            new_call = v1_compat_call
-            model.call = types.MethodType(new_call, model)
 
-        model.call = types.MethodType(new_call, model)
\ No newline at end of file
+def _get_num_classes(model):
+    try:
+        return model.output_shape[-1]
+    except (AttributeError, TypeError):
+        return None  # model isn't built yet, or has several outputs
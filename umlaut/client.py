@@ -1,86 +1,262 @@
+import queue
 import requests
+import threading
+import time
 from bson import ObjectId
+from requests.adapters import HTTPAdapter
 from datetime import datetime as dt
 from pymongo import MongoClient
 from pymongo import ReturnDocument
 from termcolor import colored
 
 
+# (connect, read) seconds. a server which hangs fails the request instead
+# of stalling the sender thread, and the update is spooled.
+DEFAULT_TIMEOUT = (3.05, 10.)
+
+
+def default_session_name():
+    # if no name, unnamed_{yymmdd_hhmmss} is used
+    return 'unnamed_' + dt.strftime(dt.now(), '%y%m%d_%H%M%S')
+
+
 class UmlautClient:
-    def __init__(self, session_name=None, host=None, port=5000):
+    def __init__(
+        self,
+        session_name=None,
+        host=None,
+        port=5000,
+        max_queue_size=64,
+        queue_policy='drop',
+        spool=None,
+        timeout=DEFAULT_TIMEOUT,
+    ):
         # set up host for umlaut server
         self.host = host or 'localhost'
         self.host = host + f':{port}'
+        self.timeout = timeout
+
+        # one pooled keep-alive session, so requests reuse connections
+        self._http = requests.Session()
+        self._http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
 
         # get session id from database, whether existing or new
         if not session_name:
-            # if no name, unnamed_{yymmdd_hhmmss} is used
-            session_name = 'unnamed_' + dt.strftime(dt.now(), '%y%m%d_%H%M%S')
+            session_name = default_session_name()
         self.session_id = self.get_session_id_from_name(session_name)
         print(colored('Umlaut session is live at ', 'yellow'), colored(f'http://{self.host}/session/{self.session_id}', 'cyan'))
 
+        # telemetry goes through a bounded queue drained by a background
+        # thread, so a slow server never stalls the training loop.
+        # 'drop' discards updates when the queue is full, 'block' waits.
+        if queue_policy not in ('drop', 'block'):
+            raise ValueError(f'queue_policy must be "drop" or "block", got {queue_policy}')
+        self.queue_policy = queue_policy
+        self.spool = spool  # keeps updates the server could not accept
+        self.dropped_updates = 0
+        self.http_seconds = 0.  # latency of requests sent so far
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._sender = threading.Thread(target=self._send_loop, daemon=True)
+        self._sender.start()
+
 
     def get_session_id_from_name(self, session_name):
-        r = requests.get(
+        r = self._http.get(
             f'http://{self.host}/api/getSessionIdFromUniqueName/{session_name}',
+            timeout=self.timeout,
         )
         r.raise_for_status()
         return r.text
 
 
     def send_logs_to_server(self, batch, logs):
-        if not logs:
-            return
-        val = any(k.startswith('val') for k in logs)
-        acc = [k for k in logs if k.startswith('acc')]
-        if acc:
-            acc = acc[0]  # 'acc' or 'accuracy' if tf2/1
-        metrics_dict = {
-            'loss': {
-                'train': [batch, float(logs['loss'])],
-            },
-        }
-        if val:
-            metrics_dict['loss']['val'] = [batch, float(logs['val_loss'])]
-        if acc:
-            metrics_dict['acc'] = {'train': [batch, logs[acc]]}
-            if val:
-                metrics_dict['acc']['val'] = [batch, float(logs[f'val_{acc}'])]
-        self._send_batch_metrics(metrics_dict)
+        metrics_dict = make_metrics_dict(batch, logs)
+        if metrics_dict:
+            self.send_metrics(metrics_dict)
 
 
-    def _send_batch_metrics(self, req_data):
-        '''send updated metrics to umlaut server.
-        looks like:
-        {
-            'acc': {'train': [6, 72.1], 'val': [6, 47.8]},
-            'loss': {'train': [6, 0.42], 'val': [6, 0.84]},
-        }
-        '''
-        r = requests.post(
-            f'http://{self.host}/api/updateSessionPlots/{self.session_id}',
-            json=req_data,
-        )
-        r.raise_for_status()
+    def send_metrics(self, metrics_dict):
+        '''send a plot update, formatted like make_metrics_dict.'''
+        self._enqueue('metrics', metrics_dict)
+
+
+    def pop_http_seconds(self):
+        seconds, self.http_seconds = self.http_seconds, 0.
+        return seconds
 
 
     def send_errors(self, errors):
-        '''send error messages to the server to be displayed.
-        
-        Data format is:
+        '''send error messages to the server to be displayed.'''
+        req_data = serialize_errors(errors)
+        if req_data:
+            self._enqueue('errors', req_data)
+
+
+    def flush(self, timeout=30.):
+        '''Block until every queued update has been sent, or for timeout seconds.
+
+        Updates still queued after that are written to the spool, or
+        counted as dropped without one.
+        '''
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._queue.all_tasks_done.wait(remaining)
+        unsent = []
+        while True:
+            try:
+                unsent.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            self._queue.task_done()
+        if unsent:
+            if self.spool:
+                print(colored(f'Umlaut timed out sending {len(unsent)} updates, writing them to {self.spool.path}', 'yellow'))
+                self.spool.write(**_merge_pending(unsent))
+            else:
+                self.dropped_updates += len(unsent)
+        if self.dropped_updates:
+            print(colored(f'Umlaut dropped {self.dropped_updates} updates while the server was slow.', 'yellow'))
+            self.dropped_updates = 0
+
+
+    def _enqueue(self, kind, payload):
+        try:
+            self._queue.put((kind, payload), block=self.queue_policy == 'block')
+        except queue.Full:
+            self.dropped_updates += 1
+
+
+    def _send_loop(self):
+        '''drain the queue, merging whatever is pending into as few requests as possible.'''
+        while True:
+            pending = [self._queue.get()]
+            while True:
+                try:
+                    pending.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._send_pending(pending)
+            except Exception as e:
+                # the sender must outlive any one update, or a blocking queue
+                # would stall training once it fills up
+                print(colored(f'Umlaut failed to send {len(pending)} updates: {e!r}', 'red'))
+            finally:
+                for _ in pending:
+                    self._queue.task_done()
+
+
+    def _send_pending(self, pending):
+        '''send pending metrics and errors to the umlaut server in one request.
+        looks like:
         {
-            error_id_str: {
-                epochs: [items pushed to list],
-                [remarks]: 'String with remarks from last run',
-                [source_module]: {'path': path_to_file, 'contents': file_lines},
-            }
+            'metrics': [
+                {
+                    'acc': {'train': [6, 72.1], 'val': [6, 47.8]},
+                    'loss': {'train': [6, 0.42], 'val': [6, 0.84]},
+                },
+                ...,
+            ],
+            'errors': {error_id_str: {...}, ...},
         }
         '''
-        req_data = {}
-        for error in filter(None, errors):
-            req_data[error.id_str] = error.serialized()
-        if req_data:
-            r = requests.post(
-                f'http://{self.host}/api/updateSessionErrors/{self.session_id}',
+        req_data = _merge_pending(pending)
+        if req_data['metrics'] or req_data['errors']:
+            self._post('ingest', req_data)
+
+
+    def _post(self, route, req_data):
+        start = time.perf_counter()
+        try:
+            r = self._http.post(
+                f'http://{self.host}/api/{route}/{self.session_id}',
                 json=req_data,
+                timeout=self.timeout,
             )
+            r.raise_for_status()
+        except requests.RequestException as e:
+            print(colored(f'Umlaut could not reach the server: {e}', 'yellow'))
+            if self.spool:
+                self.spool.write(**req_data)
+        finally:
+            self.http_seconds += time.perf_counter() - start
+
+
+def _merge_pending(pending):
+    '''merge queued (kind, payload) updates into one ingest document.'''
+    metrics = []
+    errors = {}
+    for kind, payload in pending:
+        if kind == 'metrics':
+            metrics.append(payload)
+        elif kind == 'errors':
+            merge_errors(errors, payload)
+    return {'metrics': metrics, 'errors': errors}
+
+
+def make_metrics_dict(batch, logs):
+    '''format epoch logs as a plot update.
+    looks like:
+    {
+        'acc': {'train': [6, 72.1], 'val': [6, 47.8]},
+        'loss': {'train': [6, 0.42], 'val': [6, 0.84]},
+    }
+    '''
+    if not logs:
+        return None
+    val = any(k.startswith('val') for k in logs)
+    acc = [k for k in logs if k.startswith('acc')]
+    if acc:
+        acc = acc[0]  # 'acc' or 'accuracy' if tf2/1
+    metrics_dict = {
+        'loss': {
+            'train': [batch, float(logs['loss'])],
+        },
+    }
+    if val:
+        metrics_dict['loss']['val'] = [batch, float(logs['val_loss'])]
+    if acc:
+        metrics_dict['acc'] = {'train': [batch, float(logs[acc])]}
+        if val:
+            metrics_dict['acc']['val'] = [batch, float(logs[f'val_{acc}'])]
+    return metrics_dict
+
+
+def serialize_errors(errors):
+    '''serialize error messages, keyed by error id.
+
+    Data format is:
+    {
+        error_id_str: {
+            epochs: [items pushed to list],
+            [remarks]: 'String with remarks from last run',
+            [source_module]: {'path': path_to_file, 'contents': file_lines},
+        }
+    }
+    '''
+    req_data = {}
+    for error in filter(None, errors):
+        req_data[error.id_str] = dict(error.serialized())
+    return req_data
+
+
+def merge_errors(errors, update):
+    '''merge serialized errors into errors, keyed by error id.
+
+    Epochs from both are unioned, other fields take the newest value.
+    '''
+    for error_id, error in update.items():
+        if error_id not in errors:
+            errors[error_id] = error
+            continue
+        merged = errors[error_id]
+        epochs = merged.get('epochs')
+        if epochs is not None and error.get('epochs') is not None:
+            epochs = sorted(set(epochs) | set(error['epochs']))
+        merged.update(error)
+        merged['epochs'] = epochs
+
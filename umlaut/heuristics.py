@@ -1,10 +1,12 @@
-import re
 import numpy as np
+import time
 import tensorflow as tf
 import tensorflow.keras.backend as K
 from termcolor import colored
 
 import umlaut.errors
+from umlaut.source import index_source_module
+from umlaut.stats import compute_input_stats
 
 
 def _print_warning(message):
@@ -20,59 +22,126 @@ def _get_acc_key(logs, val=False):
     return key + 'accuracy'
 
 
-def _search_source_module(pattern, source_module_contents):
-    line_matches = []
-    for i, line in enumerate(source_module_contents):
-        match = re.search(pattern, line)
-        if match:
-            line_matches.append((i, match))
-    return line_matches
+def _make_vscode_url(location, source_module_path):
+    return f'{source_module_path}:{location[0]+1}:{location[1]+1}'
 
 
-def _make_vscode_url(line_match, source_module_path):
-    return f'{source_module_path}:{line_match[0]+1}:{line_match[1].start()+1}'
+def _get_source_index(source_module):
+    if 'index' not in source_module:
+        source_module['index'] = index_source_module(source_module['contents'])
+    return source_module['index']
+
+
+def get_module_ref(construct, source_module, last=False):
+    '''Returns a vscode url to the first (or last) call of construct, e.g. `model.fit`.'''
+    locations = _get_source_index(source_module).get(construct)
+    if locations:
+        return _make_vscode_url(locations[-1 if last else 0], source_module['path'])
+    return None
 
 
 def get_model_construction_vscode_link(source_module):
-    line_matches = _search_source_module('model\.add', source_module['contents'])[::-1]
-    if not line_matches:
-        line_matches = _search_source_module('tf\.keras\.Model', source_module['contents'])
-    if not line_matches:
-        line_matches = _search_source_module('tf\.keras\.Sequential', source_module['contents'])
-    if line_matches:
-        return _make_vscode_url(line_matches[0], source_module['path'])
+    module_ref = (
+        get_module_ref('model.add', source_module, last=True)
+        or get_module_ref('Model', source_module)
+        or get_module_ref('Sequential', source_module)
+    )
+    if module_ref:
+        return module_ref
     _print_warning('Could not find module path.')
 
 
-def get_module_ref_from_pattern(pattern, source_module):
-    line_matches = _search_source_module(pattern, source_module['contents'])
-    if line_matches:
-        return _make_vscode_url(line_matches[0], source_module['path'])
-    else:
-        return None
+def get_fit_vscode_link(source_module):
+    return get_module_ref('model.fit', source_module) or get_module_ref('fit', source_module)
+
+
+# cost classes, cheapest first. the scheduler runs cheap checks first.
+COST_CLASSES = ('cheap', 'moderate', 'expensive')
+
+# every registered heuristic, see `heuristic`
+HEURISTICS = []
+
+
+def heuristic(cadence='epoch', needs=(), optional=(), cost='cheap', every=1):
+    '''Registers a check with the heuristic scheduler.
+
+    cadence is 'once' (before training), 'batch' or 'epoch', and the check
+    runs every `every` batches or epochs. needs names the keyword arguments
+    the check is called with (epoch, logs, model, optimizer, input_stats,
+    ...), and the check is skipped while any of them is unavailable.
+    optional arguments are passed as None when unavailable.
+    '''
+    assert cadence in ('once', 'batch', 'epoch')
+    assert cost in COST_CLASSES
+
+    def register(check):
+        HEURISTICS.append({
+            'check': check,
+            'cadence': cadence,
+            'needs': tuple(needs),
+            'optional': tuple(optional),
+            'cost': cost,
+            'every': every,
+        })
+        return check
+
+    return register
+
+
+class HeuristicScheduler:
+    '''Runs the registered heuristics which are due and have their inputs.'''
+    def __init__(self, heuristics=None, max_cost='expensive'):
+        allowed_costs = COST_CLASSES[:COST_CLASSES.index(max_cost) + 1]
+        self.heuristics = sorted(
+            [h for h in (heuristics or HEURISTICS) if h['cost'] in allowed_costs],
+            key=lambda h: COST_CLASSES.index(h['cost']),
+        )
+        self._ran_once = set()
+        self.last_timings = {}  # seconds taken by each check in the last run
+
+    def due(self, cadence, step=0):
+        return [
+            h for h in self.heuristics
+            if h['cadence'] == cadence
+            and step % h['every'] == 0
+            and h['check'] not in self._ran_once
+        ]
+
+    def run(self, cadence, step=0, **context):
+        errors_raised = []
+        self.last_timings = {}
+        for h in self.due(cadence, step):
+            if any(context.get(k) is None for k in h['needs']):
+                continue
+            if cadence == 'once':
+                self._ran_once.add(h['check'])
+            kwargs = {k: context[k] for k in h['needs']}
+            kwargs.update({k: context.get(k) for k in h['optional']})
+            start = time.perf_counter()
+            errors_raised.append(h['check'](**kwargs))
+            self.last_timings[h['check'].__name__] = time.perf_counter() - start
+        return list(filter(None, errors_raised))
 
 
 def run_pretrain_heuristics(model, source_module):
-    errors_raised = []
-    errors_raised.append(check_softmax_computed_before_loss(model, source_module))
-    errors_raised.append(check_missing_activations(model, source_module))
-    errors_raised.append(check_no_activation_last_layer(model, source_module))
-    errors_raised.append(check_dropout_p_less_than_half(model))
-    errors_raised = list(filter(None, errors_raised))
-    return errors_raised
-
-
-def run_epoch_heuristics(epoch, model, logs, model_input, source_module):
-    errors_raised = []
-    errors_raised.append(check_input_shape(epoch, model_input))
-    errors_raised.append(check_input_normalization(epoch, model_input, source_module))
-    errors_raised.append(check_input_is_floating(epoch, model_input, source_module))
-    errors_raised.append(check_nan_in_loss(epoch, model_input, logs))
-    errors_raised.append(check_learning_rate_range(epoch, model))
-    errors_raised.append(check_overfitting(epoch, model, logs))
-    errors_raised.append(check_high_validation_acc(epoch, logs))
-    errors_raised = list(filter(None, errors_raised))
-    return errors_raised
+    return HeuristicScheduler().run('once', model=model, source_module=source_module)
+
+
+def run_epoch_heuristics(epoch, model, logs, input_stats, source_module, output_stats=None):
+    if isinstance(input_stats, np.ndarray):
+        # a raw input batch, reduce it once for all of the input checks
+        input_stats = compute_input_stats(input_stats)
+    return HeuristicScheduler().run(
+        'epoch',
+        epoch,
+        epoch=epoch,
+        model=model,
+        optimizer=getattr(model, 'optimizer', None),
+        logs=logs,
+        input_stats=input_stats,
+        output_stats=output_stats,
+        source_module=source_module,
+    )
 
 
 def check_accuracy_is_added_to_metrics(logs, source_module):
@@ -83,62 +152,184 @@ def check_validation_is_added_to_fit(logs, source_module):
     NotImplemented
 
 
-def check_input_shape(epoch, x_train):
-    #TODO x_train is actually model_input (from last batch)
-    if x_train is None:
-        _print_warning('train data not provided to umlaut, skipping heuristics')
-        return
+@heuristic(needs=('epoch', 'input_stats'))
+def check_input_shape(epoch, input_stats):
+    shape = input_stats['shape']
+    if shape is None:
+        return  # rank unknown until the data is read
     if K.image_data_format() == 'channels_first':
-        if len(x_train.shape) == 4 and x_train.shape[2] != x_train.shape[3]:
-            remark = f'Epoch {epoch}: Input shape is not H,C,H,W. Instead got {x_train.shape}'
+        if len(shape) == 4 and shape[2] != shape[3]:
+            remark = f'Epoch {epoch}: Input shape is not H,C,H,W. Instead got {shape}'
             return umlaut.errors.InputWrongShapeError(epoch, remark)
-    elif len(x_train.shape) == 4 and x_train.shape[1] != x_train.shape[2]:
-        remark = f'Epoch {epoch}: Input shape is not N,H,W,C. Instead got {x_train.shape}'
+    elif len(shape) == 4 and shape[1] != shape[2]:
+        remark = f'Epoch {epoch}: Input shape is not N,H,W,C. Instead got {shape}'
         return umlaut.errors.InputWrongShapeError(epoch, remark)
 
 
 
-def check_input_normalization(epoch, x_train, source_module):
+@heuristic(needs=('epoch', 'input_stats', 'source_module'))
+def check_input_normalization(epoch, input_stats, source_module):
     '''Returns an `InputNotNormalizedError` if inputs exceed bounds.
     '''
-    x_min = np.min(x_train)
-    x_max = np.max(x_train)
+    if input_stats['min'] is None:
+        return
+    x_min = input_stats['min']
+    x_max = input_stats['max']
     remark = ''
     if x_min < -1:
         remark = remark + f'Epoch {epoch}: minimum input value is {x_min}, less than the typical value of -1.'
     if x_max > 1:
         remark = remark + f'Epoch {epoch}: maximum input value is {x_max}, greater than the typical value of 1.'
     if remark:
-        module_ref = get_module_ref_from_pattern('model\.fit', source_module)
+        module_ref = get_fit_vscode_link(source_module)
         return umlaut.errors.InputNotNormalizedError(epoch, remark, module_ref)
 
 
-def check_input_is_floating(epoch, x_train, source_module):
+@heuristic(needs=('epoch', 'input_stats', 'source_module'))
+def check_input_is_floating(epoch, input_stats, source_module):
     '''Returns an `InputNotFloatingError` if input is not floating.
     '''
-    #TODO x_train is actually model_input (from last batch)
-    # x_train is a numpy object, not a tensor
-    if x_train is None:
-        _print_warning('train data not provided to umlaut, skipping heuristics')
-        return
-    if not tf.as_dtype(x_train.dtype).is_floating:
-        remarks = f'Epoch {epoch}: Input type is {x_train.dtype}'
-        module_ref = get_module_ref_from_pattern('model\.fit', source_module)
+    if not tf.as_dtype(input_stats['dtype']).is_floating:
+        remarks = f'Epoch {epoch}: Input type is {input_stats["dtype"]}'
+        module_ref = get_fit_vscode_link(source_module)
         return umlaut.errors.InputNotFloatingError(epoch, remarks, module_ref)
 
 
-def check_nan_in_loss(epoch, x_train, logs):
+@heuristic(needs=('epoch', 'logs'), optional=('input_stats',))
+def check_nan_in_loss(epoch, input_stats, logs):
     '''Returns a NanInLossError if loss is NaN.
     '''
-    #TODO x_train is actually model_input (from last batch)
     loss = logs['loss']
     if np.isnan(loss):
-        if x_train is None:
+        if input_stats is None:
             _print_warning('train data not provided to umlaut, skipping heuristics')
-        elif np.isnan(x_train).any():
+        elif input_stats['nan_count']:
             return umlaut.errors.NaNInInputError(epoch)
 
 
+@heuristic(cadence='batch', needs=('epoch', 'batch', 'logs'), optional=('input_stats',))
+def check_nan_in_batch_loss(epoch, batch, logs, input_stats):
+    '''Returns a NaNInInputError or NaNInLossError as soon as a batch loss is not finite.
+    '''
+    loss = float(logs['loss'])
+    if np.isfinite(loss):
+        return
+    remark = f'Epoch {epoch}, batch {batch}: loss is {loss}.'
+    if input_stats is not None and input_stats['nan_count']:
+        return umlaut.errors.NaNInInputError(epoch, remark)
+    return umlaut.errors.NaNInLossError(epoch, remark)
+
+
+@heuristic(needs=('epoch', 'output_stats'))
+def check_nan_in_output(epoch, output_stats):
+    '''Returns a NaNInOutputError if the model produced NaN outputs.
+    '''
+    if output_stats['nan_count']:
+        remark = f'Epoch {epoch}: {output_stats["nan_count"]} model outputs were NaN.'
+        return umlaut.errors.NaNInOutputError(epoch, remark)
+
+
+@heuristic(needs=('epoch', 'logs', 'output_stats'))
+def check_output_saturation(epoch, logs, output_stats):
+    '''Returns an OutputSaturatedError if predictions are saturated but often wrong.
+    '''
+    saturated = output_stats['saturated_fraction']
+    acc_key = _get_acc_key(logs)
+    if saturated is None or acc_key not in logs:
+        return
+    if saturated > 0.9 and logs[acc_key] < 0.9:
+        remark = (
+            f'Epoch {epoch}: {100. * saturated:.2f}% of predictions have a top class probability above 99%, '
+            f'but training accuracy is {100. * logs[acc_key]:.2f}%. '
+            f'Logits range from {output_stats["min"]} to {output_stats["max"]}.'
+        )
+        return umlaut.errors.OutputSaturatedError(epoch, remark)
+
+
+@heuristic(needs=('epoch', 'output_stats'))
+def check_prediction_collapse(epoch, output_stats):
+    '''Returns a PredictionCollapseError if almost every prediction is one class.
+    '''
+    class_counts = output_stats['class_counts']
+    if not class_counts or len(class_counts) < 3 or not sum(class_counts):
+        return
+    top_class = int(np.argmax(class_counts))
+    top_fraction = class_counts[top_class] / sum(class_counts)
+    if top_fraction > 0.9:
+        remark = f'Epoch {epoch}: class {top_class} was predicted for {100. * top_fraction:.2f}% of training examples.'
+        return umlaut.errors.PredictionCollapseError(epoch, remark)
+
+
+@heuristic(needs=('epoch', 'gradient_stats'))
+def check_exploding_gradients(epoch, gradient_stats):
+    '''Returns an ExplodingGradientsError if gradients are huge or not finite.
+    '''
+    err_layers = [l for l in gradient_stats['layers'] if l['grad_norm_max'] > 1e3]
+    remarks = [f'Layer {l["name"]} has a gradient norm of up to {l["grad_norm_max"]:.3g}' for l in err_layers]
+    if gradient_stats['nonfinite_samples']:
+        remarks.insert(0, f'{gradient_stats["nonfinite_samples"]} of {gradient_stats["samples"]} sampled steps had NaN or Inf gradients')
+    if remarks:
+        remark = f'Epoch {epoch}: ' + '\n'.join(remarks)
+        return umlaut.errors.ExplodingGradientsError(epoch, remark)
+
+
+@heuristic(needs=('epoch', 'gradient_stats'))
+def check_vanishing_gradients(epoch, gradient_stats):
+    '''Returns a VanishingGradientsError if updates are negligible next to the weights.
+    '''
+    err_layers = [l for l in gradient_stats['layers'] if l['update_ratio_mean'] < 1e-7]
+    if err_layers:
+        remark = f'Epoch {epoch}: ' + '\n'.join(
+            f'Layer {l["name"]} has a mean gradient norm of {l["grad_norm_mean"]:.3g} and update to weight ratio of {l["update_ratio_mean"]:.3g}'
+            for l in err_layers
+        )
+        return umlaut.errors.VanishingGradientsError(epoch, remark)
+
+
+@heuristic(needs=('epoch', 'activation_stats'))
+def check_dead_relus(epoch, activation_stats):
+    '''Returns a DeadReLUError if most units of a relu layer never activated this epoch.
+    '''
+    err_layers = [
+        (name, l['dead_unit_fraction']) for name, l in activation_stats.items()
+        if l['activation'] == 'relu' and l['dead_unit_fraction'] > 0.5
+    ]
+    if err_layers:
+        remark = f'Epoch {epoch}: ' + '\n'.join(
+            f'Layer {l[0]} has {100. * l[1]:.2f}% of units which output zero for every sampled input' for l in err_layers)
+        return umlaut.errors.DeadReLUError(epoch, remark)
+
+
+@heuristic(needs=('epoch', 'activation_stats'))
+def check_saturated_activations(epoch, activation_stats):
+    '''Returns a SaturatedActivationError if sigmoid or tanh outputs sit at their bounds.
+    '''
+    err_layers = [
+        (name, l['activation'], l['saturated_fraction']) for name, l in activation_stats.items()
+        if l['activation'] in ('sigmoid', 'tanh') and l['saturated_fraction'] > 0.5
+    ]
+    if err_layers:
+        remark = f'Epoch {epoch}: ' + '\n'.join(
+            f'Layer {l[0]} ({l[1]}) has {100. * l[2]:.2f}% of outputs saturated' for l in err_layers)
+        return umlaut.errors.SaturatedActivationError(epoch, remark)
+
+
+@heuristic(needs=('epoch', 'activation_stats'))
+def check_activation_growth(epoch, activation_stats):
+    '''Returns an ActivationGrowthError if activations grew by over 50% for 3 epochs in a row.
+    '''
+    err_layers = []
+    for name, l in activation_stats.items():
+        history = l['mean_abs_history'][-4:]
+        if len(history) == 4 and all(b > 1.5 * a > 0 for a, b in zip(history, history[1:])):
+            err_layers.append((name, history))
+    if err_layers:
+        remark = f'Epoch {epoch}: ' + '\n'.join(
+            f'Layer {l[0]} mean activation magnitude grew from {l[1][0]:.3g} to {l[1][-1]:.3g} over 3 epochs' for l in err_layers)
+        return umlaut.errors.ActivationGrowthError(epoch, remark)
+
+
+@heuristic(cadence='once', needs=('model', 'source_module'))
 def check_softmax_computed_before_loss(model, source_module):
     '''Ensures the loss function used has a proper from_logits setting.
     '''
@@ -153,8 +344,9 @@ def check_softmax_computed_before_loss(model, source_module):
         module_ref = get_model_construction_vscode_link(source_module)
         return umlaut.errors.NoSoftmaxActivationError(None, module_url=module_ref)
 
-def check_learning_rate_range(epoch, model):
-    lr = K.eval(model.optimizer.lr)
+@heuristic(needs=('epoch', 'optimizer'))
+def check_learning_rate_range(epoch, optimizer):
+    lr = K.eval(optimizer.lr)
     if lr > 0.01 or lr < 1e-7:
         remarks = f'Epoch {epoch}: Learning Rate is {lr}'
         if lr > 0.01:
@@ -163,6 +355,7 @@ def check_learning_rate_range(epoch, model):
             return umlaut.errors.LRLowError(epoch, remarks)
 
 
+@heuristic(needs=('epoch', 'model', 'logs'))
 def check_overfitting(epoch, model, logs):
     if not model.history.history:
         return
@@ -176,6 +369,7 @@ def check_overfitting(epoch, model, logs):
             return umlaut.errors.OverfittingError(epoch, remark)
 
 
+@heuristic(needs=('epoch', 'logs'))
 def check_high_validation_acc(epoch, logs):
     if epoch < 3:
         # validation accuracy can be a bit random at first, ignore the noise
@@ -191,6 +385,7 @@ def check_high_validation_acc(epoch, logs):
         return umlaut.errors.OverconfidentValAccuracy(epoch, remark)
 
 
+@heuristic(cadence='once', needs=('model', 'source_module'))
 def check_missing_activations(model, source_module):
     '''Raises a MissingActivationError if there are linear activations between layers.
     '''
@@ -208,6 +403,7 @@ def check_missing_activations(model, source_module):
         return umlaut.errors.MissingActivationError(epochs=None, remarks=remarks, module_url=module_ref)
 
 
+@heuristic(cadence='once', needs=('model', 'source_module'))
 def check_no_activation_last_layer(model, source_module):
     last_layer = model.layers[-1]
     layer_config = last_layer.get_config()
@@ -223,6 +419,7 @@ def check_no_activation_last_layer(model, source_module):
             return umlaut.errors.FinalLayerHasActivationError(epochs=None, remarks=remark, module_url=module_ref)
 
 
+@heuristic(cadence='once', needs=('model',))
 def check_dropout_p_less_than_half(model):
     err_layers = []
     for i, layer in enumerate(model.layers[:-1]):
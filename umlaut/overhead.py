@@ -0,0 +1,90 @@
+import time
+from contextlib import contextmanager
+from termcolor import colored
+
+
+class OverheadTracker:
+    '''Accumulates the wall time umlaut adds to each epoch, by category.
+
+    Categories are 'shim' (in-graph capture), 'transfer' (fetching stats
+    from the device), 'heuristics', 'batch' (the loss sync and heuristics
+    of the checks between batches) and 'http'. HTTP requests are sent from
+    a background thread, so their latency is reported but doesn't block
+    training.
+    '''
+    categories = ('shim', 'transfer', 'heuristics', 'batch', 'http')
+
+    def __init__(self):
+        self.seconds = {}
+        self.heuristic_seconds = {}
+        self._epoch_start = None
+
+    def start_epoch(self):
+        self.seconds = {k: 0. for k in self.categories}
+        self.heuristic_seconds = {}
+        self._epoch_start = time.perf_counter()
+
+    def add(self, category, seconds):
+        self.seconds[category] = self.seconds.get(category, 0.) + seconds
+
+    @contextmanager
+    def timed(self, category):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(category, time.perf_counter() - start)
+
+    def end_epoch(self):
+        '''Returns the epoch's overhead report.
+
+        looks like:
+        {
+            'epoch_seconds': 12.3,
+            'seconds': {'shim': 0.2, ..., 'total': 0.5},
+            'fractions': {'shim': 0.016, ..., 'total': 0.04},
+            'heuristic_seconds': {'check_overfitting': 0.001, ...},
+        }
+        '''
+        epoch_seconds = time.perf_counter() - (self._epoch_start or time.perf_counter())
+        seconds = dict(self.seconds)
+        # http runs in the background, so it doesn't count towards the total
+        seconds['total'] = sum(v for k, v in seconds.items() if k != 'http')
+        return {
+            'epoch_seconds': epoch_seconds,
+            'seconds': seconds,
+            'fractions': {k: v / epoch_seconds if epoch_seconds else 0. for k, v in seconds.items()},
+            'heuristic_seconds': dict(self.heuristic_seconds),
+        }
+
+
+def format_overhead_report(epoch, report):
+    seconds = report['seconds']
+    fractions = report['fractions']
+    parts = ', '.join(
+        f'{k} {seconds[k]:.3f}s ({100. * fractions[k]:.2f}%)'
+        for k in OverheadTracker.categories
+    )
+    message = f'Epoch {epoch}: umlaut overhead {seconds["total"]:.3f}s ({100. * fractions["total"]:.2f}% of epoch): {parts}'
+    if report['heuristic_seconds']:
+        slowest = max(report['heuristic_seconds'], key=report['heuristic_seconds'].get)
+        message += f', slowest heuristic {slowest} {report["heuristic_seconds"][slowest]:.3f}s'
+    return message
+
+
+def print_overhead_report(epoch, report, budget=None):
+    '''prints the report, warning if umlaut took more than budget of the epoch.'''
+    print(colored(format_overhead_report(epoch, report), 'cyan'))
+    if budget is not None and report['fractions']['total'] > budget:
+        print(colored('WARNING: ', 'red'), colored(
+            f'umlaut overhead exceeded its budget of {100. * budget:.2f}% of the epoch.', 'yellow'))
+
+
+def make_overhead_metrics_dict(epoch, report):
+    '''format an overhead report as a plot update, in percent of the epoch.'''
+    return {
+        'overhead': {
+            k: [epoch, 100. * report['fractions'][k]]
+            for k in OverheadTracker.categories + ('total',)
+        },
+    }
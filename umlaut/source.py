@@ -0,0 +1,54 @@
+import ast
+import re
+
+_CALL_PATTERN = re.compile(r'([A-Za-z_][\w\.]*)\s*\(')
+
+
+def index_source_module(contents):
+    '''Maps every called name in a script to where it is called.
+
+    Each call is indexed under its full dotted name (`model.fit`,
+    `tf.keras.Sequential`) and its last component (`fit`, `Sequential`).
+    Locations are (line, col) pairs, both zero based, in source order.
+    The AST gives exact positions, including for calls spanning lines;
+    scripts which don't parse are indexed line by line with a regex.
+    '''
+    try:
+        calls = _calls_from_ast('\n'.join(contents))
+    except SyntaxError:
+        calls = _calls_from_regex(contents)
+
+    index = {}
+    for name, location in sorted(calls, key=lambda c: c[1]):
+        index.setdefault(name, []).append(location)
+        short_name = name.rsplit('.', 1)[-1]
+        if short_name != name:
+            index.setdefault(short_name, []).append(location)
+    return index
+
+
+def _dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        prefix = _dotted_name(node.value)
+        return f'{prefix}.{node.attr}' if prefix else node.attr
+    return None
+
+
+def _calls_from_ast(source):
+    calls = []
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Call):
+            name = _dotted_name(node.func)
+            if name:
+                calls.append((name, (node.func.lineno - 1, node.func.col_offset)))
+    return calls
+
+
+def _calls_from_regex(contents):
+    calls = []
+    for i, line in enumerate(contents):
+        for match in _CALL_PATTERN.finditer(line):
+            calls.append((match[1], (i, match.start())))
+    return calls
@@ -0,0 +1,151 @@
+import json
+import os
+import requests
+import sqlite3
+import threading
+from termcolor import colored
+
+from umlaut.client import merge_errors
+
+# (connect, read) seconds. replayed batches are large, so reads get longer
+REPLAY_TIMEOUT = (3.05, 60.)
+
+
+class UmlautSpool:
+    '''Append-only local record of a session's telemetry.
+
+    Every record is an ingest document ({'metrics': [...], 'errors': {...}})
+    appended to a SQLite file, which `replay` can later bulk upload to an
+    umlaut server. The file is only created on the first write.
+
+    Once the client has a session on the server, its id is kept with the
+    records, so a replay appends to that session instead of starting a
+    new one.
+    '''
+    def __init__(self, path, session_name):
+        self.path = path
+        self.session_name = session_name
+        self.session_id = None
+        self.session_host = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+
+    def set_session(self, session_id, host):
+        '''records the server session the spooled updates belong to.'''
+        with self._lock:
+            self.session_id = session_id
+            self.session_host = host
+            if self._conn is not None:
+                _set_meta(self._conn, 'session_id', session_id)
+                _set_meta(self._conn, 'session_host', host)
+
+
+    def write(self, metrics=None, errors=None):
+        doc = {'metrics': metrics or [], 'errors': errors or {}}
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT INTO records (doc) VALUES (?)', (json.dumps(doc),))
+            conn.commit()
+
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = _open_spool(self.path)
+            self._conn.execute(
+                'INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)',
+                ('session_name', self.session_name),
+            )
+            self._conn.commit()
+            if self.session_id is not None:
+                _set_meta(self._conn, 'session_id', self.session_id)
+                _set_meta(self._conn, 'session_host', self.session_host)
+        return self._conn
+
+
+def default_spool_path(session_name):
+    return os.path.join('umlaut_spool', f'{session_name}.sqlite')
+
+
+def _open_spool(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # WAL keeps appends cheap, losing the last write on power loss is fine
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY AUTOINCREMENT, doc TEXT)')
+    return conn
+
+
+def _get_meta(conn, key):
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(conn, key, value):
+    conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+    conn.commit()
+
+
+def replay(spool_path, host='localhost', port=5000, batch_size=500):
+    '''Upload a spool to an umlaut server, batch_size records per request.
+
+    Progress is stored in the spool, so an interrupted replay resumes
+    into the same session without duplicating records. Updates spooled
+    after the run reached the server go to the run's own session on that
+    server, a new session is only made for runs which never reached it.
+    '''
+    if not os.path.exists(spool_path):
+        raise FileNotFoundError(spool_path)
+    conn = _open_spool(spool_path)
+    http = requests.Session()
+    base_url = f'http://{host}:{port}/api'
+
+    session_id = _get_meta(conn, 'session_id')
+    session_host = _get_meta(conn, 'session_host')
+    if session_host is not None and session_host != f'{host}:{port}':
+        session_id = None  # the run's session is on another server
+    if session_id is None:
+        r = http.get(
+            f'{base_url}/getSessionIdFromUniqueName/{_get_meta(conn, "session_name")}',
+            timeout=REPLAY_TIMEOUT,
+        )
+        r.raise_for_status()
+        session_id = r.text
+        _set_meta(conn, 'session_id', session_id)
+        _set_meta(conn, 'session_host', f'{host}:{port}')
+
+    last_id = int(_get_meta(conn, 'replayed_id') or 0)
+    while True:
+        rows = conn.execute(
+            'SELECT id, doc FROM records WHERE id > ? ORDER BY id LIMIT ?',
+            (last_id, batch_size),
+        ).fetchall()
+        if not rows:
+            break
+        metrics = []
+        errors = {}
+        for _, doc in rows:
+            doc = json.loads(doc)
+            metrics.extend(doc['metrics'])
+            merge_errors(errors, doc['errors'])
+        r = http.post(
+            f'{base_url}/ingest/{session_id}',
+            json={'metrics': metrics, 'errors': errors},
+            timeout=REPLAY_TIMEOUT,
+        )
+        r.raise_for_status()
+        last_id = rows[-1][0]
+        _set_meta(conn, 'replayed_id', last_id)
+
+    conn.close()
+    print(colored('Umlaut spool replayed to ', 'yellow'), colored(f'http://{host}:{port}/session/{session_id}', 'cyan'))
+    return session_id
@@ -0,0 +1,546 @@
+import contextlib
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras.backend as K
+
+
+class _Accumulators:
+    '''float64 accumulator variables, reset every epoch and fetched in one transfer.
+
+    Under a distribution strategy each replica accumulates into its own
+    copy (ON_READ), so the training step never synchronizes them. They are
+    reduced across replicas and workers on device when fetched.
+    '''
+    # variable key -> 'min' or 'max', every other variable is summed
+    _reductions = {}
+
+    def _create_vars(self, prefix, strategy=None):
+        self.strategy = strategy
+        self._fetcher = None  # built on the first fetch
+        scope = strategy.scope() if strategy is not None else contextlib.nullcontext()
+        with scope:
+            self._vars = {
+                k: tf.Variable(
+                    v,
+                    dtype=tf.float64,
+                    trainable=False,
+                    name=f'{prefix}_{k}',
+                    synchronization=tf.VariableSynchronization.ON_READ,
+                    aggregation=tf.VariableAggregation.SUM,
+                )
+                for k, v in self._initial_values.items()
+            }
+
+    def reset_values(self):
+        return [(self._vars[k], v) for k, v in self._initial_values.items()]
+
+    def reset(self):
+        K.batch_set_value(self.reset_values())
+
+    def variables_to_fetch(self):
+        return [(self._vars[k], self._reductions.get(k, 'sum')) for k in self._vars]
+
+    def values_from(self, fetched):
+        '''takes this accumulator's values from an iterator over fetched values'''
+        return {k: next(fetched) for k in self._vars}
+
+    def fetch(self):
+        if self._fetcher is None:
+            self._fetcher = AccumulatorFetcher(self.variables_to_fetch(), self.strategy)
+        return self.values_from(iter(self._fetcher.fetch()))
+
+    def result(self):
+        return self.make_result(self.fetch())
+
+
+class AccumulatorFetcher:
+    '''Reads (variable, reduction) pairs, reduced across replicas on device.
+
+    The reduction is a tf.function built once per set of variables, so it
+    is traced on the first fetch only, and each fetch is one strategy.run.
+    '''
+    def __init__(self, to_fetch, strategy=None):
+        self.to_fetch = to_fetch
+        self.strategy = strategy
+        self._reduce_fn = None
+
+    def fetch(self):
+        variables = [v for v, _ in self.to_fetch]
+        if self.strategy is None or self.strategy.num_replicas_in_sync == 1:
+            return K.batch_get_value(variables)
+
+        if self._reduce_fn is None:
+            self._reduce_fn = self._make_reduce_fn()
+        sums, extremes = [
+            self.strategy.experimental_local_results(r)[0].numpy()
+            for r in self.strategy.run(self._reduce_fn)
+        ]
+        sources = {'sum': sums, 'min': extremes, 'max': -extremes}
+        offsets = {'sum': 0, 'min': 0, 'max': sum(int(np.prod(v.shape)) for v, r in self.to_fetch if r == 'min')}
+        values = []
+        for v, r in self.to_fetch:
+            size = int(np.prod(v.shape))
+            values.append(sources[r][offsets[r]:offsets[r] + size].reshape(v.shape.as_list()))
+            offsets[r] += size
+        return values
+
+    def _make_reduce_fn(self):
+        def flat(vs):
+            if not vs:
+                return tf.zeros([0], tf.float64)
+            # in replica context this reads the replica's own copy
+            return tf.concat([tf.reshape(tf.identity(v), [-1]) for v in vs], 0)
+
+        summed = [v for v, r in self.to_fetch if r == 'sum']
+        minned = [v for v, r in self.to_fetch if r == 'min']
+        maxed = [v for v, r in self.to_fetch if r == 'max']
+
+        @tf.function
+        def reduce_fn():
+            ctx = tf.distribute.get_replica_context()
+            sums = ctx.all_reduce(tf.distribute.ReduceOp.SUM, flat(summed))
+            # there is no min or max all-reduce, so gather the few values instead
+            extremes = tf.concat([flat(minned), -flat(maxed)], 0)
+            extremes = tf.reduce_min(ctx.all_gather(extremes[None], axis=0), axis=0)
+            return sums, extremes
+
+        return reduce_fn
+
+
+class AccumulatorGroup:
+    '''Accumulators fetched together at epoch end, in a single transfer.
+
+    results() returns each accumulator's result in order, None for
+    accumulators which are None, e.g. switched off.
+    '''
+    def __init__(self, accumulators, strategy=None):
+        self.accumulators = accumulators
+        self._fetcher = AccumulatorFetcher(
+            [pair for a in accumulators if a is not None for pair in a.variables_to_fetch()],
+            strategy,
+        )
+
+    def results(self):
+        fetched = iter(self._fetcher.fetch())
+        return [
+            a.make_result(a.values_from(fetched)) if a is not None else None
+            for a in self.accumulators
+        ]
+
+
+class InputStatsAccumulator(_Accumulators):
+    '''Running statistics of every model input seen during an epoch.
+
+    The statistics live in a few scalar variables which are updated in
+    graph, so only those scalars are copied to the host at epoch end.
+    '''
+    _initial_values = {
+        'min': np.inf,
+        'max': -np.inf,
+        'sum': 0.,
+        'sum_sq': 0.,
+        'count': 0.,
+        'nan_count': 0.,
+        'inf_count': 0.,
+    }
+    _reductions = {'min': 'min', 'max': 'max'}
+
+    def __init__(self, strategy=None):
+        self.dtype = None
+        self.shape = None
+        self._create_vars('umlaut_input', strategy)
+
+    def update(self, x):
+        '''Returns an op folding the batch x into the running statistics.'''
+        # dtype and shape are static, so they are recorded while tracing
+        self.dtype = x.dtype
+        self.shape = tuple(x.shape.as_list())
+
+        if x.dtype.is_floating:
+            finite = tf.math.is_finite(x)
+            nan_count = tf.reduce_sum(tf.cast(tf.math.is_nan(x), tf.float64))
+            inf_count = tf.reduce_sum(tf.cast(tf.math.is_inf(x), tf.float64))
+            batch_min = tf.reduce_min(tf.where(finite, x, tf.ones_like(x) * x.dtype.max))
+            batch_max = tf.reduce_max(tf.where(finite, x, tf.ones_like(x) * x.dtype.min))
+            x = tf.where(finite, x, tf.zeros_like(x))
+        else:
+            nan_count = inf_count = tf.constant(0., tf.float64)
+            batch_min = tf.reduce_min(x)
+            batch_max = tf.reduce_max(x)
+        # integer inputs are cast so the sums don't overflow
+        x = tf.cast(x, K.floatx())
+
+        v = self._vars
+        return tf.group(
+            v['min'].assign(tf.minimum(v['min'], tf.cast(batch_min, tf.float64))),
+            v['max'].assign(tf.maximum(v['max'], tf.cast(batch_max, tf.float64))),
+            v['sum'].assign_add(tf.cast(tf.reduce_sum(x), tf.float64)),
+            v['sum_sq'].assign_add(tf.cast(tf.reduce_sum(tf.square(x)), tf.float64)),
+            v['count'].assign_add(tf.cast(tf.size(x), tf.float64)),
+            v['nan_count'].assign_add(nan_count),
+            v['inf_count'].assign_add(inf_count),
+        )
+
+    def make_result(self, values):
+        '''The input stats record of the fetched values, or None if nothing was seen.'''
+        return make_input_stats(self.dtype, self.shape, values)
+
+
+def compute_input_stats(x, chunk_size=1 << 20):
+    '''Computes the input stats record of an array in a single pass.
+
+    The array is reduced chunk_size elements at a time along its first
+    axis, so temporaries stay chunk sized instead of array sized.
+    '''
+    x = np.asarray(x)
+    values = dict(InputStatsAccumulator._initial_values)
+    _reduce_array(x, values, chunk_size)
+    return make_input_stats(x.dtype, x.shape, values)
+
+
+def compute_batches_stats(batches, dtype, shape, chunk_size=1 << 20):
+    '''Computes one input stats record over several arrays, e.g. dataset batches.'''
+    values = dict(InputStatsAccumulator._initial_values)
+    for x in batches:
+        _reduce_array(np.asarray(x), values, chunk_size)
+    return make_input_stats(dtype, shape, values)
+
+
+def make_spec_input_stats(dtype, shape):
+    '''An input stats record with only the dtype and shape, and no values.'''
+    return {
+        'dtype': tf.as_dtype(dtype).name,
+        'shape': shape,
+        'min': None,
+        'max': None,
+        'mean': None,
+        'std': None,
+        'count': 0,
+        'nan_count': 0,
+        'inf_count': 0,
+    }
+
+
+def _reduce_array(x, values, chunk_size):
+    is_floating = np.issubdtype(x.dtype, np.floating)
+    batch = x.reshape(1, -1) if x.ndim == 0 else x
+    row_size = max(1, batch[0].size) if len(batch) else 1
+    rows_per_chunk = max(1, chunk_size // row_size)
+
+    for start in range(0, len(batch), rows_per_chunk):
+        chunk = batch[start:start + rows_per_chunk]
+        if is_floating:
+            nan = np.isnan(chunk)
+            finite = np.isfinite(chunk)
+            nan_count = np.count_nonzero(nan)
+            values['nan_count'] += nan_count
+            values['inf_count'] += chunk.size - nan_count - np.count_nonzero(finite)
+        else:
+            finite = True
+            chunk = chunk.astype(np.float64)  # integer sums would overflow
+        values['min'] = min(values['min'], float(np.min(chunk, where=finite, initial=np.inf)))
+        values['max'] = max(values['max'], float(np.max(chunk, where=finite, initial=-np.inf)))
+        values['sum'] += float(np.sum(chunk, where=finite, dtype=np.float64))
+        values['sum_sq'] += float(np.sum(np.square(chunk, dtype=np.float64), where=finite))
+        values['count'] += chunk.size
+
+
+def make_input_stats(dtype, shape, values):
+    '''Builds the input stats record read by the input heuristics.
+
+    values holds the accumulated min, max, sum, sum_sq, count,
+    nan_count and inf_count.
+    '''
+    count = values['count']
+    if not count:
+        return None
+    finite_count = count - values['nan_count'] - values['inf_count']
+    x_min = x_max = mean = std = None
+    if finite_count:
+        x_min = float(values['min'])
+        x_max = float(values['max'])
+        mean = float(values['sum'] / finite_count)
+        std = float(np.sqrt(max(values['sum_sq'] / finite_count - mean ** 2, 0.)))
+    return {
+        'dtype': tf.as_dtype(dtype).name if dtype is not None else None,
+        'shape': shape,
+        'min': x_min,
+        'max': x_max,
+        'mean': mean,
+        'std': std,
+        'count': int(count),
+        'nan_count': int(values['nan_count']),
+        'inf_count': int(values['inf_count']),
+    }
+
+
+class OutputStatsAccumulator(_Accumulators):
+    '''Running summaries of model outputs seen during an epoch.
+
+    Tracks the logit range, NaN count, the fraction of rows whose top
+    class probability is saturated and, when the number of classes is
+    known, how often each class is predicted.
+    '''
+    saturation_threshold = 0.99
+    _reductions = {'min': 'min', 'max': 'max'}
+
+    def __init__(self, num_classes=None, outputs_are_probabilities=False, strategy=None):
+        self.num_classes = num_classes
+        self.outputs_are_probabilities = outputs_are_probabilities
+        self._initial_values = {
+            'min': np.inf,
+            'max': -np.inf,
+            'nan_count': 0.,
+            'rows': 0.,
+            'saturated': 0.,
+        }
+        if num_classes and num_classes > 1:
+            self._initial_values['class_counts'] = np.zeros(num_classes)
+        self._create_vars('umlaut_output', strategy)
+
+    def update(self, out):
+        '''Returns an op folding the batch of outputs into the summaries.'''
+        finite = tf.math.is_finite(out)
+        v = self._vars
+        updates = [
+            v['min'].assign(tf.minimum(v['min'], tf.cast(
+                tf.reduce_min(tf.where(finite, out, tf.ones_like(out) * out.dtype.max)), tf.float64))),
+            v['max'].assign(tf.maximum(v['max'], tf.cast(
+                tf.reduce_max(tf.where(finite, out, tf.ones_like(out) * out.dtype.min)), tf.float64))),
+            v['nan_count'].assign_add(tf.reduce_sum(tf.cast(tf.math.is_nan(out), tf.float64))),
+        ]
+        if 'class_counts' in v:
+            probs = out if self.outputs_are_probabilities else tf.nn.softmax(out)
+            top_prob = tf.reduce_max(probs, axis=-1)
+            predictions = tf.reshape(tf.argmax(probs, axis=-1), [-1])
+            updates.extend([
+                v['rows'].assign_add(tf.cast(tf.size(top_prob), tf.float64)),
+                v['saturated'].assign_add(tf.reduce_sum(
+                    tf.cast(top_prob > self.saturation_threshold, tf.float64))),
+                v['class_counts'].assign_add(tf.cast(
+                    tf.math.bincount(tf.cast(predictions, tf.int32), minlength=self.num_classes, maxlength=self.num_classes),
+                    tf.float64)),
+            ])
+        return tf.group(*updates)
+
+    def make_result(self, values):
+        '''The summaries of the fetched values, or None if nothing was seen.'''
+        if values['min'] > values['max'] and not values['nan_count']:
+            return None  # no outputs were captured
+        output_stats = {
+            'min': float(values['min']) if values['min'] <= values['max'] else None,
+            'max': float(values['max']) if values['min'] <= values['max'] else None,
+            'nan_count': int(values['nan_count']),
+            'saturated_fraction': None,
+            'class_counts': None,
+        }
+        if values['rows']:
+            output_stats['saturated_fraction'] = float(values['saturated'] / values['rows'])
+            output_stats['class_counts'] = [int(c) for c in values['class_counts']]
+        return output_stats
+
+
+class GradientStatsAccumulator(_Accumulators):
+    '''Per-layer gradient norms and update-to-weight ratios, sampled in graph.
+
+    Gradients are reduced to one norm per layer inside the train step, so
+    only a few numbers per layer are copied to the host at epoch end. The
+    update ratio is learning_rate * |grad| / |weights|, which is exact for
+    plain SGD and a proxy for adaptive optimizers.
+    '''
+    _reductions = {'grad_norm_max': 'max'}
+
+    def __init__(self, variables, sample_every=10, strategy=None):
+        self.sample_every = sample_every
+        self.layer_names = []
+        for var in variables:
+            if _layer_name(var) not in self.layer_names:
+                self.layer_names.append(_layer_name(var))
+        self._layer_index = {name: i for i, name in enumerate(self.layer_names)}
+        n_layers = len(self.layer_names)
+        self._initial_values = {
+            'grad_norm_sum': np.zeros(n_layers),
+            'grad_norm_max': np.zeros(n_layers),
+            'ratio_sum': np.zeros(n_layers),
+            'samples': 0.,
+            'nonfinite': 0.,
+        }
+        self._create_vars('umlaut_gradient', strategy)
+
+    def update(self, grads_and_vars, learning_rate):
+        '''Returns an op folding one step's gradients into the statistics.'''
+        grad_sq = [tf.constant(0., tf.float64)] * len(self.layer_names)
+        weight_sq = list(grad_sq)
+        for grad, var in grads_and_vars:
+            i = self._layer_index.get(_layer_name(var))
+            if grad is None or i is None:
+                continue
+            if isinstance(grad, tf.IndexedSlices):
+                grad = grad.values
+            grad_sq[i] += tf.cast(tf.reduce_sum(tf.square(grad)), tf.float64)
+            weight_sq[i] += tf.cast(tf.reduce_sum(tf.square(var)), tf.float64)
+        grad_norm = tf.sqrt(tf.stack(grad_sq))
+        ratio = tf.cast(learning_rate, tf.float64) * grad_norm / (tf.sqrt(tf.stack(weight_sq)) + 1e-12)
+        finite = tf.reduce_all(tf.math.is_finite(grad_norm))
+
+        v = self._vars
+        return tf.group(
+            v['grad_norm_sum'].assign_add(tf.where(tf.math.is_finite(grad_norm), grad_norm, tf.zeros_like(grad_norm))),
+            v['grad_norm_max'].assign(tf.maximum(v['grad_norm_max'], grad_norm)),
+            v['ratio_sum'].assign_add(tf.where(tf.math.is_finite(ratio), ratio, tf.zeros_like(ratio))),
+            v['samples'].assign_add(1.),
+            v['nonfinite'].assign_add(1. - tf.cast(finite, tf.float64)),
+        )
+
+    def wrap_optimizer(self, optimizer):
+        '''Samples gradients every sample_every steps from inside apply_gradients.'''
+        apply_gradients = optimizer.apply_gradients
+
+        def sampled_apply_gradients(grads_and_vars, *args, **kwargs):
+            grads_and_vars = list(grads_and_vars)
+            learning_rate = optimizer.lr
+            if callable(learning_rate):  # a LearningRateSchedule
+                learning_rate = learning_rate(optimizer.iterations)
+
+            def update():
+                with tf.control_dependencies([self.update(grads_and_vars, learning_rate)]):
+                    return tf.constant(True)
+
+            sampled = tf.equal(optimizer.iterations % self.sample_every, 0)
+            with tf.control_dependencies([tf.cond(sampled, update, lambda: tf.constant(False))]):
+                return apply_gradients(grads_and_vars, *args, **kwargs)
+
+        optimizer.apply_gradients = sampled_apply_gradients
+
+    def make_result(self, values):
+        '''The statistics of the fetched values, or None if nothing was sampled.'''
+        samples = values['samples']
+        if not samples:
+            return None
+        return {
+            'samples': int(samples),
+            'nonfinite_samples': int(values['nonfinite']),
+            'layers': [
+                {
+                    'name': name,
+                    'grad_norm_mean': float(values['grad_norm_sum'][i] / samples),
+                    'grad_norm_max': float(values['grad_norm_max'][i]),
+                    'update_ratio_mean': float(values['ratio_sum'][i] / samples),
+                }
+                for i, name in enumerate(self.layer_names)
+            ],
+        }
+
+
+def _layer_name(var):
+    return var.name.split('/')[0]
+
+
+class ActivationSketch(_Accumulators):
+    '''Fixed-size summary of one layer's activations over an epoch.
+
+    Keeps the fraction of zeros, how often each unit was nonzero, the
+    fraction of saturated sigmoid/tanh outputs, the mean magnitude and a
+    histogram of magnitudes in power-of-two buckets. Its memory depends on
+    the layer width only, not on batch size or epoch length.
+    '''
+    min_exponent = -20  # magnitudes below 2**-20, and zeros, share bucket 0
+    max_exponent = 20
+
+    def __init__(self, name, units, activation, strategy=None):
+        self.name = name
+        self.units = units
+        self.activation = activation  # 'relu', 'sigmoid', 'tanh', ...
+        self.n_buckets = self.max_exponent - self.min_exponent + 2
+        self._initial_values = {
+            'count': 0.,
+            'zeros': 0.,
+            'saturated': 0.,
+            'abs_sum': 0.,
+            'unit_active': np.zeros(units),
+            'rows': 0.,
+            'histogram': np.zeros(self.n_buckets),
+        }
+        self._create_vars(f'umlaut_{name}', strategy)
+
+    def update(self, a):
+        '''Returns an op folding a batch of activations into the sketch.'''
+        a = tf.cast(a, tf.float32)
+        abs_a = tf.reshape(tf.abs(a), [-1])
+        exponent = tf.floor(tf.math.log(tf.maximum(abs_a, 1e-30)) / np.log(2.))
+        bucket = tf.where(
+            abs_a >= 2. ** self.min_exponent,
+            tf.clip_by_value(exponent - self.min_exponent + 1, 1, self.n_buckets - 1),
+            tf.zeros_like(abs_a),
+        )
+        histogram = tf.math.bincount(
+            tf.cast(bucket, tf.int32), minlength=self.n_buckets, maxlength=self.n_buckets)
+        if self.activation == 'sigmoid':
+            saturated = tf.logical_or(a < 0.01, a > 0.99)
+        elif self.activation == 'tanh':
+            saturated = tf.abs(a) > 0.99
+        else:
+            saturated = tf.zeros_like(a, dtype=tf.bool)
+        units_active = tf.reshape(tf.cast(tf.not_equal(a, 0.), tf.float64), [-1, self.units])
+
+        v = self._vars
+        return tf.group(
+            v['count'].assign_add(tf.cast(tf.size(abs_a), tf.float64)),
+            v['zeros'].assign_add(tf.reduce_sum(tf.cast(tf.equal(abs_a, 0.), tf.float64))),
+            v['saturated'].assign_add(tf.reduce_sum(tf.cast(saturated, tf.float64))),
+            v['abs_sum'].assign_add(tf.cast(tf.reduce_sum(abs_a), tf.float64)),
+            v['unit_active'].assign_add(tf.reduce_sum(units_active, axis=0)),
+            v['rows'].assign_add(tf.cast(tf.shape(units_active)[0], tf.float64)),
+            v['histogram'].assign_add(tf.cast(histogram, tf.float64)),
+        )
+
+    def make_result(self, values):
+        if not values['count']:
+            return None
+        histogram = values['histogram']
+        return {
+            'activation': self.activation,
+            'zero_fraction': float(values['zeros'] / values['count']),
+            'saturated_fraction': float(values['saturated'] / values['count']),
+            'dead_unit_fraction': float(np.mean(values['unit_active'] == 0)),
+            'mean_abs': float(values['abs_sum'] / values['count']),
+            # bucket i > 0 holds magnitudes in [2**(i - 21), 2**(i - 20))
+            'histogram': [int(c) for c in histogram],
+        }
+
+
+class ActivationMonitor:
+    '''Activation sketches of several layers, fetched in a single transfer.
+
+    Also remembers each layer's mean magnitude for the last 10 epochs, so
+    heuristics can see how activations evolve across epochs.
+    '''
+    def __init__(self, sketches, strategy=None):
+        self.sketches = sketches
+        self.strategy = strategy
+        self.mean_abs_history = {s.name: [] for s in sketches}
+        self._fetcher = AccumulatorFetcher(self.variables_to_fetch(), strategy)
+
+    def reset(self):
+        K.batch_set_value([pair for s in self.sketches for pair in s.reset_values()])
+
+    def variables_to_fetch(self):
+        return [pair for s in self.sketches for pair in s.variables_to_fetch()]
+
+    def values_from(self, fetched):
+        return {s.name: s.values_from(fetched) for s in self.sketches}
+
+    def result(self):
+        return self.make_result(self.values_from(iter(self._fetcher.fetch())))
+
+    def make_result(self, values):
+        activation_stats = {}
+        for s in self.sketches:
+            layer_stats = s.make_result(values[s.name])
+            if layer_stats is None:
+                continue
+            history = self.mean_abs_history[s.name][-9:] + [layer_stats['mean_abs']]
+            self.mean_abs_history[s.name] = history
+            layer_stats['mean_abs_history'] = list(history)
+            activation_stats[s.name] = layer_stats
+        return activation_stats or None
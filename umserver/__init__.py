@@ -19,6 +19,11 @@ from umserver import callbacks
 # expose internal flask object for serving
 server = app.server
 
+# make sure the database has the indexes umserver queries by, once the
+# server starts serving rather than on import
+from umserver.models import ensure_indexes
+server.before_first_request(ensure_indexes)
+
 if __name__ == '__main__':
     # using layout.app since app doesn't have a layout until then
     layout.app.run_server(debug=True)
\ No newline at end of file
@@ -1,15 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import bson
-import re
 from bson import ObjectId
 from datetime import datetime as dt
+from flask import Response
 from flask import abort
+from flask import jsonify
 from flask import request
+from flask import stream_with_context
 from pymongo import ReturnDocument
+from pymongo import UpdateOne
 
 from umserver import app
+from umserver.live import notifier
+from umserver.models import create_uniquely_named_session
 from umserver.models import db
+from umserver.models import get_session_seq
+from umserver.models import make_plot_bucket_op
+from umserver.models import make_plot_level_ops
+from umserver.models import publish_session_seq
+from umserver.models import reserve_session_seq
+from umserver.models import search_sessions
 
 # get the internal flask object for client facing API
 server = app.server
@@ -33,23 +44,146 @@ def get_sessionid_str_from_name(sess_name):
 
 @server.route('/api/getSessionIdFromUniqueName/<sess_name>', methods=['GET'])
 def get_session_id_from_making_unique_name(sess_name):
-    '''Find a session named session_name, otherwise make it.
+    '''Make a new session named session_name.
     
     If one already exists, add a (safely incremented) _{int} to the end.
     '''
-    ses_candidates = list(db.sessions.find({'name': {'$regex': sess_name + '(?:_\d+)?$'}}))
-    if not ses_candidates:
-        return get_sessionid_str_from_name(sess_name)
-    max_incr = 0
-    for s in ses_candidates:
-        s = s['name']
-        incr = re.search('_(\d+)$', s)
-        if incr:
-            incr = int(incr[1])
-            if incr > max_incr:
-                max_incr = incr
-    sess_name = sess_name + f'_{max_incr + 1}'
-    return get_sessionid_str_from_name(sess_name)
+    return str(create_uniquely_named_session(sess_name))
+
+
+def _get_session_id_or_abort(sess_id):
+    '''Parses a session id and reserves its next sequence number for a write.
+
+    The reservation also tells whether the session exists, so a write costs
+    no extra round trip to check it.
+    '''
+    try:
+        sess_id = ObjectId(sess_id)
+    except bson.errors.InvalidId:
+        abort(400)
+    seq = reserve_session_seq(sess_id)
+    if seq is None:
+        abort(404)  # session not found
+    return sess_id, seq
+
+
+def _make_plot_ops(sess_id, metrics):
+    '''Returns (bucket ops, level ops) for a list of plot updates.
+
+    One bucket append per stream, with every point sent for it, and the
+    upserts folding those points into the stream's downsampled levels.
+    '''
+    streams = {}
+    for updates in metrics:
+        for plot_name in updates:  # loss, acc
+            for plot_col in updates[plot_name]:  # train, val
+                update_data = updates[plot_name][plot_col]
+                assert len(list(update_data)) == 2  # [epochs, data]
+                streams.setdefault((plot_name, plot_col), []).append(update_data)
+                print(f'epoch {update_data[0]}: {plot_name}.{plot_col} <-+ {update_data[1]}')
+    bucket_ops, level_ops = [], []
+    for (plot_name, plot_col), points in streams.items():
+        bucket_ops.append(make_plot_bucket_op(sess_id, plot_name, plot_col, points))
+        level_ops.extend(make_plot_level_ops(sess_id, plot_name, plot_col, points))
+    return bucket_ops, level_ops
+
+
+def _extend_epoch_ranges(epochs):
+    '''An update expression adding epochs to the stored [start, end] ranges.
+
+    The stored ranges are kept sorted and apart. Each epoch is merged with
+    the ranges it is within or adjacent to, and the result put between
+    those before and after it, so an error recurring every epoch stays a
+    single range. Epochs may come in any order, such as when a second fit
+    starts over at epoch 0, or a spool is replayed.
+    '''
+    start = {'$arrayElemAt': ['$$range', 0]}
+    end = {'$arrayElemAt': ['$$range', 1]}
+    before = {'$filter': {
+        'input': '$$value', 'as': 'range',
+        'cond': {'$lt': [end, {'$subtract': ['$$this', 1]}]},
+    }}
+    after = {'$filter': {
+        'input': '$$value', 'as': 'range',
+        'cond': {'$gt': [start, {'$add': ['$$this', 1]}]},
+    }}
+    touching = {'$filter': {
+        'input': '$$value', 'as': 'range',
+        'cond': {'$and': [
+            {'$gte': [end, {'$subtract': ['$$this', 1]}]},
+            {'$lte': [start, {'$add': ['$$this', 1]}]},
+        ]},
+    }}
+    return {'$reduce': {
+        'input': sorted(set(epochs)),
+        'initialValue': {'$ifNull': ['$epoch_ranges', []]},
+        'in': {'$let': {
+            'vars': {'touching': touching},
+            'in': {'$concatArrays': [
+                before,
+                # $min and $max skip the nulls of no touching ranges
+                [[
+                    {'$min': ['$$this', {'$min': {'$map': {
+                        'input': '$$touching', 'as': 'range', 'in': start,
+                    }}}]},
+                    {'$max': ['$$this', {'$max': {'$map': {
+                        'input': '$$touching', 'as': 'range', 'in': end,
+                    }}}]},
+                ]],
+                after,
+            ]},
+        }},
+    }}
+
+
+def _make_error_ops(sess_id, errors, seq):
+    ops = []
+    for error_id in errors:
+        fields = {
+            'session_id': sess_id,
+            'error_id_str': error_id,
+            'seq': seq,
+        }
+        if errors[error_id]['epochs'] is None:
+            # don't make a list of None's from global errors, just set once.
+            fields['epoch_ranges'] = None
+        else:
+            fields['epoch_ranges'] = _extend_epoch_ranges(errors[error_id]['epochs'])
+        for k in errors[error_id]:
+            if k not in ('epochs', 'epoch_ranges', 'session_id', 'error_id_str', 'seq'):
+                # add any remaining keys sent over to the db, as literals
+                # since a pipeline would read strings starting with $ as fields
+                fields[k] = {'$literal': errors[error_id][k]}
+
+        ops.append(UpdateOne(
+            {'error_id_str': error_id, 'session_id': sess_id},
+            # a pipeline update, so the ranges are extended in place
+            [{'$set': fields}],
+            upsert=True,
+        ))
+    return ops
+
+
+def _write_session_plots(sess_id, metrics):
+    '''writes a list of plot updates in a single round trip.'''
+    bucket_ops, level_ops = _make_plot_ops(sess_id, metrics)
+    if bucket_ops:
+        db.plot_buckets.bulk_write(bucket_ops, ordered=False)
+        db.plot_levels.bulk_write(level_ops, ordered=False)
+
+
+def _write_session_errors(sess_id, errors, seq):
+    '''writes every error in a single round trip.'''
+    ops = _make_error_ops(sess_id, errors, seq)
+    if ops:
+        db.errors.bulk_write(ops, ordered=False)
+
+
+def _notify_session_update(sess_id, seq):
+    # only once written, publish the new version for dashboards, and wake
+    # up its live streams
+    publish_session_seq(sess_id, seq)
+    notifier.notify(sess_id, seq)
 
 
 @server.route('/api/updateSessionPlots/<sess_id>', methods=['POST'])
@@ -66,61 +200,102 @@ def update_session_plots(sess_id):
         ...,
     }
     '''
-    try:
-        sess_id = ObjectId(sess_id)
-    except bson.errors.InvalidId:
-        abort(400)
-    if db.sessions.find_one(sess_id) is None:
-        abort(404)  # session not found
-
+    sess_id, seq = _get_session_id_or_abort(sess_id)
     updates = request.get_json()
-    for plot_name in updates:  # loss, acc
-        for plot_col in updates[plot_name]:  # train, val
-            update_data = updates[plot_name][plot_col]
-            assert len(list(update_data)) == 2  # [epochs, data]
-            db.plots.update(
-                {'session_id': sess_id, 'name': plot_name},
-                {'$push': {'streams.' + plot_col: update_data}},
-                upsert=True,
-            )
-            print(f'epoch {update_data[0]}: {plot_name}.{plot_col} <-+ {update_data[1]}')
+    _write_session_plots(sess_id, [updates])
+    _notify_session_update(sess_id, seq)
     return f'Updated {str(len(updates))}'
 
 
 @server.route('/api/updateSessionErrors/<sess_id>', methods=['POST'])
 def update_session_errors(sess_id):
     '''Receive an error message id and store in the db.'''
+    sess_id, seq = _get_session_id_or_abort(sess_id)
+    errors = request.get_json()
+    _write_session_errors(sess_id, errors, seq)
+    _notify_session_update(sess_id, seq)
+    return f'Updated {str(len(errors))}'
+
+
+@server.route('/api/ingest/<sess_id>', methods=['POST'])
+def ingest(sess_id):
+    '''Store metrics and errors sent together in one document.
+
+    the document is structured as follows:
+
+    {
+        'metrics': [<updateSessionPlots body>, ...],
+        'errors': <updateSessionErrors body>,
+    }
+    '''
+    sess_id, seq = _get_session_id_or_abort(sess_id)
+    doc = request.get_json()
+    metrics = doc.get('metrics') or []
+    errors = doc.get('errors') or {}
+    _write_session_plots(sess_id, metrics)
+    _write_session_errors(sess_id, errors, seq)
+    _notify_session_update(sess_id, seq)
+    return f'Updated {str(len(metrics))} metrics, {str(len(errors))} errors'
+
+
+@server.route('/api/sessions', methods=['GET'])
+def list_sessions():
+    '''Search sessions by name prefix, most recently modified first.
+
+    takes ?q=<prefix>&limit=<int>&cursor=<next from the previous page>
+    and returns {'sessions': [{'label': name, 'value': id}, ...], 'next': cursor}
+    '''
+    try:
+        limit = min(int(request.args.get('limit', 20)), 100)
+        sessions, next_cursor = search_sessions(
+            request.args.get('q', ''),
+            limit=max(limit, 1),
+            cursor=request.args.get('cursor'),
+        )
+    except (ValueError, bson.errors.InvalidId):
+        abort(400)
+    return jsonify({'sessions': sessions, 'next': next_cursor})
+
+
+# seconds between heartbeats on an idle stream
+STREAM_HEARTBEAT = 15
+
+
+@server.route('/api/stream/<sess_id>', methods=['GET'])
+def stream_session_updates(sess_id):
+    '''Server-sent events carrying a session's sequence number when it gets data.
+
+    One event is sent on connect, so the dashboard catches up with
+    anything written before it was listening. Idle streams send a comment
+    every STREAM_HEARTBEAT seconds to keep the connection open, and then
+    also check the database, for writes another server process received.
+    '''
     try:
         sess_id = ObjectId(sess_id)
     except bson.errors.InvalidId:
         abort(400)
-    if db.sessions.find_one(sess_id) is None:
+    seq = get_session_seq(sess_id)
+    if seq is None:
         abort(404)  # session not found
 
-    errors = request.get_json()
-    for error_id in errors:
-        error_obj = {
-            '$set': {
-                'session_id': sess_id,
-                'error_id_str': error_id,
-            },
-        }
-        if errors[error_id]['epochs'] is None:
-            # don't make a list of None's from global errors, just set once.
-            error_obj['$set'].update({'epochs': None})
-        else:
-            error_obj['$addToSet'] = {
-                # $each to iterate through list
-                'epochs': {'$each': errors[error_id]['epochs']},
-            }
-        for k in errors[error_id]:
-            if k not in ('epochs', 'session_id', 'error_id_str'):
-                # add any remaining keys sent over to the db
-                error_obj['$set'].update({k: errors[error_id][k]})
+    def events(seq):
+        # registered until the client disconnects and the generator is closed
+        with notifier.watching(sess_id) as wait:
+            # anything published before the stream was registered
+            seq = max(seq, get_session_seq(sess_id) or 0)
+            yield f'data: {seq}\n\n'
+            while True:
+                latest = wait(seq, STREAM_HEARTBEAT)
+                if latest is None:
+                    latest = get_session_seq(sess_id) or 0
+                    if latest <= seq:
+                        yield ': heartbeat\n\n'
+                        continue
+                seq = latest
+                yield f'data: {seq}\n\n'
 
-        db.errors.find_one_and_update(
-            {'error_id_str': error_id, 'session_id': sess_id},
-            error_obj,
-            upsert=True,
-        )
-    return f'Updated {str(len(errors))}'
\ No newline at end of file
+    return Response(
+        stream_with_context(events(seq)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
@@ -0,0 +1,39 @@
+// Listens for updates to the session in the url, pushed by
+// /api/stream/<session id>, and clicks the hidden live-update button so
+// the dashboard fetches them. Nothing is polled while a session is idle.
+(function() {
+    var source = null;
+    var sessionId = null;
+
+    function sessionFromPath(pathname) {
+        var path = pathname.split('/');
+        var i = path.indexOf('session');
+        return i === -1 ? null : path[i + 1] || null;
+    }
+
+    function watch() {
+        var current = sessionFromPath(window.location.pathname);
+        if (current === sessionId) {
+            return;
+        }
+        if (source) {
+            source.close();
+            source = null;
+        }
+        sessionId = current;
+        if (!sessionId) {
+            return;
+        }
+        source = new EventSource('/api/stream/' + sessionId);
+        source.onmessage = function() {
+            var button = document.getElementById('live-update');
+            if (button) {
+                button.click();
+            }
+        };
+    }
+
+    // dash changes the url with pushState, which fires no event
+    window.setInterval(watch, 500);
+    watch();
+})();
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+from collections import OrderedDict
+
+# most memory the cache holds, measured as the size of its values in json
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+
+class SessionStateCache:
+    '''Process-wide LRU cache of state and figures computed from session data.
+
+    Keys start with a session id and the session's version, its sequence
+    number, which ingest bumps on every write and dashboards read from
+    the database. A new version makes new keys, and entries for old ones
+    age out. When several dashboards ask for the same key at once, one
+    computes it and the rest wait for it.
+    '''
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._computing = {}  # key -> threading.Event, set once computed
+
+    def get_or_compute(self, key, compute):
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key][0]
+                event = self._computing.get(key)
+                if event is None:
+                    event = self._computing[key] = threading.Event()
+                    break
+            # another request is computing it. if that fails, try again here
+            event.wait()
+
+        try:
+            value = compute()
+            self._put(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._computing.pop(key).set()
+
+    def _put(self, key, value):
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return  # would evict everything else
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+
+state_cache = SessionStateCache()
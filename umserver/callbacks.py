@@ -4,63 +4,153 @@ import bson
 import dash
 import json
 import random
+import zlib
 import dash_core_components as dcc
-import dash_html_components as html
 from dash.dependencies import Input, Output, State, ALL, MATCH
 from dash.exceptions import PreventUpdate
 from bson import ObjectId
-from flask import abort
 from flask import request
 
 from umserver import app
+from umserver.cache import state_cache
 from umserver.errors import ERROR_KEYS
 from umserver.errors import get_error_color
-from umserver.helpers import argmax, index_of_dict
-from umserver.models import db
-from umserver.models import get_training_sessions
+from umserver.helpers import argmax, filter_for_dict, index_of_dict
+from umserver.models import get_session_errors
+from umserver.models import get_session_seq
+from umserver.models import get_session_streams
+from umserver.models import get_session_option
+from umserver.models import search_sessions
 
 
 # ---------- Helper Functions for Rendering ---------- #
 
 
+def _get_session_id_from_path(pathname):
+    # fetch session from URL: /session/session_id
+    path = pathname.split('/')
+    try:
+        return ObjectId(path[path.index('session') + 1])
+    except (ValueError, IndexError, bson.errors.InvalidId):
+        return None
+
+
+# sessions listed in the session picker at once
+SESSION_PICKER_LIMIT = 50
+
+# most points sent to plotly per stream, downsampled beyond that
+MAX_PLOT_POINTS = 2000
+
+
 def get_go_data_from_metrics(plot, metrics_data):
     '''populate graph_figure.data from metrics_data'''
-    return [  # make a plot for every plot stream
-        {
+    data = []
+    for k in metrics_data.get(plot, {}):  # make a plot for every plot stream
+        data.append({
             'x': metrics_data[plot][k][0],
             'y': metrics_data[plot][k][1],
             'name': k,
             'type': 'line+marker',
-        } for k in metrics_data[plot]
-    ]
+        })
+    return data
+
+
+def get_zoomed_x_range(relayout_data):
+    '''the x range the graph was zoomed into, or None when showing everything'''
+    if not relayout_data or 'xaxis.range[0]' not in relayout_data:
+        return None
+    return [relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']]
+
+
+def get_session_metrics(metrics_version, x_range=None):
+    '''Reads the streams of the session in metrics-version, None without one.
+
+    Streams longer than MAX_PLOT_POINTS are drawn from the store's
+    downsampled levels, so only what is shown is read, and only that
+    crosses the wire. Dashboards showing the same version of a session
+    share the read.
+    '''
+    session = metrics_version.get('session') if metrics_version else None
+    if session is None:
+        return None
+    x_min, x_max = x_range or (None, None)
+    return state_cache.get_or_compute(
+        ('streams', session, metrics_version['seq'], json.dumps(x_range)),
+        lambda: get_session_streams(ObjectId(session), x_min, x_max, max_points=MAX_PLOT_POINTS),
+    )
+
+
+def make_metrics_figure(plot, title, metrics_version, annotations_data, relayout_data, pathname):
+    '''Builds a metric's figure, at full resolution within a zoomed x range.
+
+    Figures are shared by dashboards showing the same version of a
+    session with the same selections.
+    '''
+    key = (
+        'figure',
+        metrics_version['session'],
+        metrics_version['seq'],
+        plot,
+        json.dumps(annotations_data, sort_keys=True),
+        json.dumps(get_zoomed_x_range(relayout_data)),
+    )
+    return state_cache.get_or_compute(key, lambda: _make_metrics_figure(
+        plot, title, metrics_version, annotations_data, relayout_data, pathname))
+
+
+def _make_metrics_figure(plot, title, metrics_version, annotations_data, relayout_data, pathname):
+    x_range = get_zoomed_x_range(relayout_data)
+    graph_figure = {
+        'layout': {
+            'title': title,
+            'shapes': [],
+            # keep the user's zoom when the figure is updated
+            'uirevision': pathname,
+        },
+        'data': get_go_data_from_metrics(plot, get_session_metrics(metrics_version, x_range)),
+    }
+    if x_range is not None:
+        graph_figure['layout']['xaxis'] = {'range': x_range}
+
+    if annotations_data:
+        for annotation in annotations_data:  # for every selected error
+            if 'ranges' not in annotation:
+                continue  # ignore static checks (no ranges)
+            for epoch_range in annotation['ranges']:
+                graph_figure['layout']['shapes'].append(
+                    make_annotation_box_shape(epoch_range, annotation['error-id'])
+                )
+
+    return graph_figure
 
 
-def make_annotation_box_shape(x1, error_idx):
+def make_annotation_box_shape(epoch_range, error_id_str):
     return {
         'type': 'rect',
         'xref': 'x',
         'yref': 'paper',
-        'x0': x1 - 1,  # x0, x1 are epoch bounds
-        'x1': x1,
+        'x0': epoch_range[0] - 1,  # x0, x1 are epoch bounds
+        'x1': epoch_range[1],
         'y0': 0,
         'y1': 1,
-        'fillcolor': get_error_color(error_idx),
+        'fillcolor': get_error_color(error_id_str),
         'opacity': 0.5,
         'layer': 'below',
         'line_width': 0,
     }
 
 
-def get_viz_trace_from_error(error_id_str, epochs, error_idx, annotated=False):
-    '''Given an error object, return a viz plot trace for it.'''
+def get_viz_trace_from_error(error_id_str, epoch_ranges, annotated=False):
+    '''Given an error object, return a viz plot trace for it, one bar per epoch range.'''
     return_data = {
         'type': 'bar',
         'marker': {
-            'color': get_error_color(error_idx),
+            'color': get_error_color(error_id_str),
         },
         'hoverinfo': 'name',
         'opacity': 1.0 if annotated else 0.9,
         'name': error_id_str,
+        'uid': error_id_str,  # keeps the trace's identity across updates
     }
 
     if annotated:
@@ -69,18 +159,25 @@ def get_viz_trace_from_error(error_id_str, epochs, error_idx, annotated=False):
             'width': 1.5,
         }
 
-    if epochs is None:
+    if epoch_ranges is None:
         return_data['x'] = [0]
         return_data['y'] = [-1]
-        return_data['customdata'] = [error_idx]
+        return_data['customdata'] = [error_id_str]
         return return_data
 
-    return_data['x'] = epochs
-    return_data['y'] = [1] * len(epochs)
-    return_data['customdata'] = [error_idx for _ in epochs] # one error id per point
+    # a bar centered on each range, as wide as the epochs it covers
+    return_data['x'] = [(start + end) / 2 for start, end in epoch_ranges]
+    return_data['width'] = [end - start + 0.95 for start, end in epoch_ranges]
+    return_data['y'] = [1] * len(epoch_ranges)
+    return_data['customdata'] = [error_id_str for _ in epoch_ranges] # one error id per bar
     return return_data
 
 
+def get_error_version(error_spec):
+    '''a checksum of an error's contents, to tell which errors changed'''
+    return zlib.crc32(json.dumps(error_spec, sort_keys=True, default=str).encode())
+
+
 # ---------- App Callbacks ---------- #
 
 @app.callback(
@@ -104,12 +201,21 @@ def update_dropdown_from_url(pathname):
 
 @app.callback(
     Output('session-picker', 'options'),
-    [Input('url-update', 'pathname')],
+    [Input('session-picker', 'search_value'), Input('session-picker', 'value')],
 )
-def update_session_picker(pathname):
-    '''populate session picker from db on page load.
+def update_session_picker(search_value, current_session):
+    '''populate session picker with the sessions matching what is typed.
+
+    the picked session stays in the options, so the dropdown can show it.
     '''
-    return get_training_sessions()
+    sessions, _ = search_sessions(search_value or '', limit=SESSION_PICKER_LIMIT)
+    try:
+        current = get_session_option(ObjectId(current_session)) if current_session else None
+    except bson.errors.InvalidId:
+        current = None
+    if current and current not in sessions:
+        sessions.append(current)
+    return sessions
 
 
 @app.callback(
@@ -135,17 +241,19 @@ def redirect_to_session_url(ses):
     ],
 )
 def style_error_indicators(annotations_cache, errors_cache, indicator_styles):
-    for style in indicator_styles:
-        style.pop('border', None)
-        style['opacity'] = 0.5  # deselected
-        style['width'] = '16px'
-        style['height'] = '16px'
-    if annotations_cache:
-        for annotation in annotations_cache:
-            indicator_styles[annotation['error-index']]['opacity'] = 1.0
-            indicator_styles[annotation['error-index']]['border'] = '2px solid #333'
-            indicator_styles[annotation['error-index']]['width'] = '12px'
-            indicator_styles[annotation['error-index']]['height'] = '12px'
+    annotated_ids = {a['error-id'] for a in annotations_cache or []}
+    indicator_ids = [o['id']['index'] for o in dash.callback_context.outputs_list]
+    for error_id, style in zip(indicator_ids, indicator_styles):
+        if error_id in annotated_ids:
+            style['opacity'] = 1.0
+            style['border'] = '2px solid #333'
+            style['width'] = '12px'
+            style['height'] = '12px'
+        else:
+            style.pop('border', None)
+            style['opacity'] = 0.5  # deselected
+            style['width'] = '16px'
+            style['height'] = '16px'
     return indicator_styles
 
 
@@ -173,7 +281,6 @@ def update_annotations_cache(clear_clicks, errors_clicks, timeline_clickdata, an
     trigger_id = trigger['prop_id'].split('.')[0]
     if not trigger['value'] or trigger_id == 'errors-cache':
         # Trigger malformed or was just a cache update
-        #TODO may have to handle errors cache update by storing error_id_strs instead of error_idx
         raise PreventUpdate
 
     # clear annotations button pressed, remove annotations
@@ -181,16 +288,15 @@ def update_annotations_cache(clear_clicks, errors_clicks, timeline_clickdata, an
         return []
 
     if trigger_id == 'timeline':
-        # might be able to use 'curveNumber' instead of 'customdata' if always ordered
-        trigger_idx = trigger['value']['points'][0]['customdata']
+        trigger_error_id = trigger['value']['points'][0]['customdata']
     else:
         # trigger_id is...probably... a dict of the error-msg id
         trigger_id = json.loads(trigger_id)
-        trigger_idx = trigger_id['index']  # error-msg.id.index
+        trigger_error_id = trigger_id['index']  # error-msg.id.index
 
     # if this error msg is already in annotations, pop it
     if annotations_cache:
-        annotations_error_idx = index_of_dict(annotations_cache, 'error-index', trigger_idx)
+        annotations_error_idx = index_of_dict(annotations_cache, 'error-id', trigger_error_id)
         if annotations_error_idx is not None:
             annotations_cache.pop(annotations_error_idx)
             return annotations_cache
@@ -198,83 +304,136 @@ def update_annotations_cache(clear_clicks, errors_clicks, timeline_clickdata, an
         annotations_cache = []
     
     clicked_error_annotation = {  # link error id to its annotations
-        'error-index': trigger_idx,
+        'error-id': trigger_error_id,
     }
 
-    if error_msgs[trigger_idx]['epochs'] is not None:
-        # not a static check, and has graph annotations. in the future this could be a different field.
-        clicked_error_annotation['indices'] = list(set(error_msgs[trigger_idx]['epochs']))
+    error_msg = filter_for_dict(error_msgs or [], 'error_id_str', trigger_error_id)
+    if error_msg is None:
+        raise PreventUpdate
+    if error_msg['epoch_ranges'] is not None:
+        # not a static check, and has graph annotations, one per range
+        clicked_error_annotation['ranges'] = error_msg['epoch_ranges']
 
     annotations_cache.append(clicked_error_annotation)
 
     return annotations_cache
 
 
+def _get_session_version(sess_id):
+    '''The session's latest version, read from the database.
+
+    Ingest may reach another server process, so nothing in this process
+    can tell the latest version. The read is a single _id lookup, and the
+    cache is kept for the reads and figures keyed by the version.
+    '''
+    return get_session_seq(sess_id) or 0
+
+
+def _last_seen_seq(delta, sess_id):
+    '''the version the dashboard has for sess_id, or None to fetch everything'''
+    if delta and delta.get('session') == str(sess_id):
+        return delta['seq']
+    return None
+
+
 @app.callback(
-    Output('metrics-cache', 'data'),
-    [Input('interval-component', 'n_intervals'), Input('url', 'pathname')],
-    [State('metrics-cache', 'data')],
+    Output('metrics-version', 'data'),
+    [Input('live-update', 'n_clicks'), Input('url', 'pathname')],
+    [State('metrics-version', 'data')],
 )
-def query_metrics(intervals, pathname, metrics_data):
-    '''handle updates to the metrics data'''
-    if intervals is None or pathname is None:
-        raise PreventUpdate
-
-    if pathname == '/':
-        return {}
-    path = pathname.split('/')
-    # fetch session from URL: /session/session_id
-    sess_id = path[path.index('session') + 1]
-    try:
-        session_plots = [s for s in db.plots.find(
-            {'session_id': ObjectId(sess_id)})]
-    except bson.errors.InvalidId:
-        return {}
+def query_metrics(live_updates, pathname, last_version):
+    '''track the version of the session's plots the figures are built from.
 
-    go_data = {}
-    for plot in session_plots:
-        # this one liner unzips each stream from [[x, y], ...] to [[x, ...], [y, ...]]
-        go_data[plot['name']] = {
-            k: list(zip(*plot['streams'][k])) for k in plot['streams']
-        }
+    {'session': <session id>, 'seq': <session's sequence number>}
 
-    if go_data == metrics_data:
-        # no difference after computing the plot data, don't rerender
+    the figures read the streams on the server, so only a version which
+    changed is sent to the browser, and only figures cross the wire.
+    '''
+    if pathname is None:
         raise PreventUpdate
 
-    return go_data
+    sess_id = _get_session_id_from_path(pathname) if pathname != '/' else None
+    if sess_id is None:
+        return {'session': None, 'seq': 0}
+
+    since = _last_seen_seq(last_version, sess_id)
+    version = _get_session_version(sess_id)
+    if since is not None and version <= since:
+        raise PreventUpdate  # nothing written since, keep the figures
+    return {'session': str(sess_id), 'seq': version}
 
 
 @app.callback(
-    Output('errors-cache', 'data'),
-    [Input('interval-component', 'n_intervals'), Input('url', 'pathname')],
-    [State('errors-cache', 'data')],
+    Output('errors-delta', 'data'),
+    [Input('live-update', 'n_clicks'), Input('url', 'pathname')],
+    [State('errors-delta', 'data')],
 )
-def query_errors(interval, pathname, errors_data):
-    '''Updates the errors cache by making an API call
+def query_errors(live_updates, pathname, last_delta):
+    '''fetch the errors added or changed since the last delta.
+
+    a delta is structured as follows, and merged into errors-cache in
+    the browser, where errors replace those with the same error_id_str.
+    reset replaces the cache instead, on a new session.
+
+    {
+        'session': <session id>,
+        'seq': <newest sequence number read>,
+        'reset': <bool>,
+        'errors': [<error>, ...],
+    }
     '''
-    if interval is None or pathname is None:
+    if pathname is None:
         raise PreventUpdate
 
-    if pathname == '/':
-        return {}
+    sess_id = _get_session_id_from_path(pathname) if pathname != '/' else None
+    if sess_id is None:
+        return {'session': None, 'seq': 0, 'reset': True, 'errors': []}
 
-    path = pathname.split('/')
-    sess_id = path[path.index('session') + 1]
-    try:
-        errors_result = list(db.errors.find(
-            {'session_id': ObjectId(sess_id)},
-            # omit object ids from results, not json friendly
-            {'_id': 0, 'session_id': 0},
-        ).sort([('epochs', -1)]))  # sort by epoch descending (latest first)
-    except bson.errors.InvalidId:
-        abort(400)
+    since = _last_seen_seq(last_delta, sess_id)
+    version = _get_session_version(sess_id)
+    if since is not None and version <= since:
+        raise PreventUpdate
 
-    if errors_result == errors_data:
-        # Errors haven't changed, don't rerender.
+    errors, seq = state_cache.get_or_compute(
+        ('errors', sess_id, version, since),
+        lambda: get_session_errors(sess_id, since=since),
+    )
+    if since is not None and not errors:
         raise PreventUpdate
+    return {'session': str(sess_id), 'seq': seq, 'reset': since is None, 'errors': errors}
 
-    return errors_result
+
+# deltas are merged in the browser, so only new data crosses the wire
+app.clientside_callback(
+    '''
+    function(delta, cache) {
+        if (!delta) {
+            return window.dash_clientside.no_update;
+        }
+        var merged = (delta.reset || !cache) ? [] : cache.slice();
+        delta.errors.forEach(function(error) {
+            var i = merged.findIndex(function(e) {
+                return e.error_id_str === error.error_id_str;
+            });
+            if (i === -1) {
+                merged.push(error);
+            } else {
+                merged[i] = error;
+            }
+        });
+        // latest first, like the query which fetched them
+        var latest = function(e) {
+            var ranges = e.epoch_ranges;
+            return ranges && ranges.length ? ranges[ranges.length - 1][1] : -1;
+        };
+        merged.sort(function(a, b) { return latest(b) - latest(a); });
+        return merged;
+    }
+    ''',
+    Output('errors-cache', 'data'),
+    [Input('errors-delta', 'data')],
+    [State('errors-cache', 'data')],
+)
 
 
 @app.callback(
@@ -287,109 +446,133 @@ def query_errors(interval, pathname, errors_data):
 )
 def render_errors_viz(errors_data, annotations_data, figure):
     '''Renders the error timeline visualization with error data
+
+    Traces are keyed by error id, and only those of errors which changed
+    or were (de)selected are rebuilt.
     '''
     if not errors_data:
         figure['data'] = []
         return figure
 
-    annotation_idxs = []
-    if annotations_data:
-        annotation_idxs = set([a['error-index'] for a in annotations_data])
+    annotated_ids = {a['error-id'] for a in annotations_data or []}
+    traces = {t.get('uid'): t for t in figure.get('data', [])}
 
     timeline_trace_data = []
-    for error_idx, error_spec in enumerate(errors_data):
-        timeline_trace_data.append(get_viz_trace_from_error(
-            error_spec['error_id_str'],
-            error_spec.get('epochs', None),
-            error_idx,
-            annotated=error_idx in annotation_idxs,
-        ))
+    for error_spec in errors_data:
+        error_id = error_spec['error_id_str']
+        version = [get_error_version(error_spec), error_id in annotated_ids]
+        trace = traces.get(error_id)
+        if trace is None or trace.get('meta') != version:
+            trace = get_viz_trace_from_error(
+                error_id,
+                error_spec.get('epoch_ranges', None),
+                annotated=error_id in annotated_ids,
+            )
+            trace['meta'] = version
+        timeline_trace_data.append(trace)
 
     figure['data'] = timeline_trace_data
     return figure
 
 
 @app.callback(
-    Output('errors-list', 'children'),
+    [
+        Output({'type': 'error-slot', 'index': ALL}, 'children'),
+        Output({'type': 'error-slot', 'index': ALL}, 'style'),
+        Output('errors-empty', 'style'),
+        Output('errors-rendered', 'data'),
+    ],
     [Input('errors-cache', 'data')],
+    [State('errors-rendered', 'data')],
 )
-def render_errors_list(errors_data):
-    '''Renders errors from errors cache changes.
-    '''
-    result_divs = []
-
-    if not errors_data:
-        return html.P('No errors found for this session.')
+def render_errors_list(errors_data, rendered):
+    '''Renders errors from errors cache changes into their slots.
 
-    if len(errors_data) == 0:
-        result_divs.append(html.P('No errors yay!'))
-
-    for i, error_spec in enumerate(errors_data):
-        #TODO make dynamic
-        result_divs.append(ERROR_KEYS[error_spec['error_id_str']](
-            error_spec['epochs'],
-            error_spec.get('remarks', None),
-            error_spec.get('module_url', None),
-        ).render(i))
-
-    return result_divs
+    Every error type has a slot in the layout, put in latest first order
+    with css. rendered maps each shown error to the [version, position]
+    it was rendered at, and slots whose error didn't change aren't sent.
+    '''
+    rendered = rendered or {}
+    errors = {e['error_id_str']: (i, e) for i, e in enumerate(errors_data or [])}
+
+    children, styles, now_rendered = [], [], {}
+    for output in dash.callback_context.outputs_list[0]:
+        error_id = output['id']['index']
+        previous = rendered.get(error_id)
+        if error_id not in errors:
+            children.append(None if previous else dash.no_update)
+            styles.append({'display': 'none'} if previous else dash.no_update)
+            continue
+
+        position, error_spec = errors[error_id]
+        version = get_error_version(error_spec)
+        now_rendered[error_id] = [version, position]
+        if previous and previous[0] == version:
+            children.append(dash.no_update)
+        else:
+            children.append(ERROR_KEYS[error_id].from_epoch_ranges(
+                error_spec['epoch_ranges'],
+                error_spec.get('remarks', None),
+                error_spec.get('module_url', None),
+            ).render())
+        if previous and previous[1] == position:
+            styles.append(dash.no_update)
+        else:
+            styles.append({'order': position})
+
+    empty_style = {'display': 'none'} if now_rendered else {}
+    return children, styles, empty_style, now_rendered
 
 
 @app.callback(
     Output('graph_loss', 'figure'),
-    [Input('metrics-cache', 'data'), Input('annotations-cache', 'data')],
+    [
+        Input('metrics-version', 'data'),
+        Input('annotations-cache', 'data'),
+        Input('graph_loss', 'relayoutData'),
+    ],
+    [State('url', 'pathname')],
 )
-def update_loss(metrics_data, annotations_data):
-    if not metrics_data:
+def update_loss(metrics_version, annotations_data, relayout_data, pathname):
+    if not metrics_version or metrics_version['session'] is None:
         return {}
+    return make_metrics_figure(
+        'loss', 'Loss over epochs', metrics_version, annotations_data, relayout_data, pathname)
 
-    graph_figure = {
-        'layout': {
-            'title': 'Loss over epochs',
-            'shapes': [],
-        },
-        'data': get_go_data_from_metrics('loss', metrics_data),
-    }
-
-    if annotations_data:
-        for annotation in annotations_data:  # for every selected error
-            if 'indices' not in annotation:
-                continue  # ignore static checks (no indices)
-            for idx in annotation['indices']:
-                graph_figure['layout']['shapes'].append(
-                    make_annotation_box_shape(idx, annotation['error-index'])
-                )
 
-    return graph_figure
+@app.callback(
+    Output('graph_acc', 'figure'),
+    [
+        Input('metrics-version', 'data'),
+        Input('annotations-cache', 'data'),
+        Input('graph_acc', 'relayoutData'),
+    ],
+    [State('url', 'pathname')],
+)
+def update_acc(metrics_version, annotations_data, relayout_data, pathname):
+    if not metrics_version or metrics_version['session'] is None:
+        return {}
+    return make_metrics_figure(
+        'acc', 'Accuracy over epochs', metrics_version, annotations_data, relayout_data, pathname)
 
 
 @app.callback(
-    Output('graph_acc', 'figure'),
-    [Input('metrics-cache', 'data'), Input('annotations-cache', 'data')],
+    Output('graph_overhead', 'figure'),
+    [Input('metrics-version', 'data')],
 )
-def update_acc(metrics_data, annotations_data):
-    if not metrics_data:
+def update_overhead(metrics_version):
+    metrics_data = get_session_metrics(metrics_version)
+    if not metrics_data or 'overhead' not in metrics_data:
         return {}
 
-    graph_figure = {
+    return {
         'layout': {
-            'title': 'Accuracy over epochs',
-            'shapes': [],
+            'title': 'Umlaut overhead over epochs',
+            'yaxis': {'title': '% of epoch time', 'rangemode': 'nonnegative'},
         },
-        'data': get_go_data_from_metrics('acc', metrics_data),
+        'data': get_go_data_from_metrics('overhead', metrics_data),
     }
 
-    if annotations_data:
-        for annotation in annotations_data:  # for every selected error
-            if 'indices' not in annotation:
-                continue  # ignore static checks (no indices)
-            for idx in annotation['indices']:
-                graph_figure['layout']['shapes'].append(
-                    make_annotation_box_shape(idx, annotation['error-index'])
-                )
-
-    return graph_figure
-
 
 if __name__ == '__main__':
     app.run_server(host='0.0.0.0', port=8888, debug=True)
@@ -19,9 +19,34 @@ REMARKS_STYLE = {
 }
 
 
-def get_error_color(error_idx):
-    '''Make a qualitative color range for 4 colors (90 degrees)'''
-    return f'hsl({(25 + 90*error_idx) % 360}, 95%, 80%)'
+def get_error_color(error_id_str):
+    '''A qualitative color per error type, stable across sessions.
+
+    Hues step by the golden angle in ERROR_KEYS order, so neighbouring
+    error types get distinct colors however many there are.
+    '''
+    error_idx = list(ERROR_KEYS).index(error_id_str) if error_id_str in ERROR_KEYS else len(ERROR_KEYS)
+    return f'hsl({(25 + 137.5*error_idx) % 360:.1f}, 95%, 80%)'
+
+
+def epochs_to_ranges(epochs):
+    '''[0, 1, 2, 5] -> [[0, 2], [5, 5]]'''
+    ranges = []
+    for epoch in sorted(set(epochs)):
+        if ranges and epoch == ranges[-1][1] + 1:
+            ranges[-1][1] = epoch
+        else:
+            ranges.append([epoch, epoch])
+    return ranges
+
+
+def format_epoch_ranges(ranges):
+    '''formats [[0, 2], [5, 5]] as 0-2, 5'''
+    return ', '.join(f'{s}' if s == e else f'{s}-{e}' for s, e in ranges)
+
+
+# error type -> its static components, see BaseErrorMessage._render_static
+_STATIC_RENDERS = {}
 
 
 class BaseErrorMessage:
@@ -30,6 +55,22 @@ class BaseErrorMessage:
     _md_solution = None
     _so_query = None
     _docs_url = None
+    _epoch_ranges = None
+
+    @classmethod
+    def from_epoch_ranges(cls, epoch_ranges, remarks=None, module_url=None):
+        '''makes an error from stored [start, end] epoch ranges, without expanding them'''
+        error = cls([] if epoch_ranges is not None else None, remarks, module_url)
+        if error.epochs is not None:
+            error._epoch_ranges = epoch_ranges
+        return error
+
+    @property
+    def epoch_ranges(self):
+        '''the epochs as sorted [start, end] ranges, None for static checks'''
+        if self.epochs is None:
+            return None
+        return self._epoch_ranges if self._epoch_ranges is not None else epochs_to_ranges(self.epochs)
 
     @property
     def description(self):
@@ -58,32 +99,63 @@ class BaseErrorMessage:
         )
 
     def get_annotations(self):
-        return [(e - 1, e) for e in self.epochs]
+        return [(start - 1, end) for start, end in self.epoch_ranges]
 
     def serialized(self):
         return self.__dict__
 
-    def render(self, error_index):
+    def _render_static(self):
+        '''The components every instance of an error type shares.
+
+        Titles, solutions and reference links are class attributes, so
+        they are rendered once per type and reused.
+        '''
+        cls = type(self)
+        if cls not in _STATIC_RENDERS:
+            header = [
+                html.Span(
+                    [
+                        html.Span(id={'type': 'error-msg-indicator', 'index': self.id_str}, style={
+                            'backgroundColor': get_error_color(self.id_str),
+                            'borderRadius': '50%',
+                            'marginRight': '5px',
+                            'display': 'inline-block',
+                        }),
+                        html.H3(self.title, style={'display': 'inline-block'}),
+                    ],
+                    style={'cursor': 'pointer'},
+                ),
+                dcc.Markdown(self.subtitle),
+            ]
+            solution = [
+                html.H4('Solution'),
+                dcc.Markdown(self.description),
+            ]
+            links = []
+            if self._so_query:
+                links.append(self._render_icon(
+                    img_url='https://cdn.sstatic.net/Sites/stackoverflow/company/Img/logos/so/so-icon.svg',
+                    caption='Search Stack Overflow',
+                    href=f'https://stackoverflow.com/search?{parse.urlencode(self._so_query)}',
+                ))
+            if self._docs_url:
+                links.append(self._render_icon(
+                    img_url='https://upload.wikimedia.org/wikipedia/commons/2/2d/Tensorflow_logo.svg',
+                    caption='Search Docs',
+                    href=self._docs_url,
+                ))
+            _STATIC_RENDERS[cls] = (header, solution, links)
+        return _STATIC_RENDERS[cls]
+
+    def render(self):
         '''Formats an error message as a Dash html component.
         
         This method assigns the id "types" of 'error-msg' and
-        'error-msg-btn-annotate' which are used by callbacks.
+        'error-msg-indicator', indexed by the error's id_str, which are
+        used by callbacks.
         '''
-        error_fmt = [
-            html.Span(
-                [
-                    html.Span(id={'type': 'error-msg-indicator', 'index': error_index}, style={
-                        'backgroundColor': get_error_color(error_index),
-                        'borderRadius': '50%',
-                        'marginRight': '5px',
-                        'display': 'inline-block',
-                    }),
-                    html.H3(self.title, style={'display': 'inline-block'}),
-                ],
-                style={'cursor': 'pointer'},
-            ),
-            dcc.Markdown(self.subtitle),
-        ]
+        header, solution, links = self._render_static()
+        error_fmt = list(header)
 
         # add error context as a formatted <pre>
         if self.remarks:
@@ -92,32 +164,18 @@ class BaseErrorMessage:
                 style=REMARKS_STYLE,
             ))
 
-        error_fmt.extend([
-            html.H4('Solution'),
-            dcc.Markdown(self.description),
-        ])
+        error_fmt.extend(solution)
 
         # write where error was captured
         if self.epochs is None:
             error_fmt.append(html.Small('Captured before start of training.'))
         else:
-            error_fmt.append(html.Small(f'Captured at epochs {self.epochs}.'))
+            error_fmt.append(html.Small(f'Captured at epochs {format_epoch_ranges(self.epoch_ranges)}.'))
 
         error_fmt.append(html.Br())
 
         # append icons + external refs to error
-        if self._so_query:
-            error_fmt.append(self._render_icon(
-                img_url='https://cdn.sstatic.net/Sites/stackoverflow/company/Img/logos/so/so-icon.svg',
-                caption='Search Stack Overflow',
-                href=f'https://stackoverflow.com/search?{parse.urlencode(self._so_query)}',
-            ))
-        if self._docs_url:
-            error_fmt.append(self._render_icon(
-                img_url='https://upload.wikimedia.org/wikipedia/commons/2/2d/Tensorflow_logo.svg',
-                caption='Search Docs',
-                href=self._docs_url,
-            ))
+        error_fmt.extend(links)
         if self.module_url:
             error_fmt.append(self._render_icon(
                 img_url='https://upload.wikimedia.org/wikipedia/commons/9/9a/Visual_Studio_Code_1.35_icon.svg',
@@ -128,7 +186,7 @@ class BaseErrorMessage:
 
         return html.Div(
             error_fmt,
-            id={'type': 'error-msg', 'index': error_index},
+            id={'type': 'error-msg', 'index': self.id_str},
             style={'display': 'inline-block'},
         )
 
@@ -212,6 +270,98 @@ class NaNInInputError(BaseErrorMessage):
     ]
 
 
+class NaNInLossError(BaseErrorMessage):
+    title = 'Critical: Loss became NaN (Not a number)'
+    subtitle = 'The training loss is NaN or infinite, so the model can no longer learn. The input data looked fine, which usually points to diverging weights.'
+    _so_query = {'q': '[keras] loss nan'}
+    _md_solution = [
+        'Lower the learning rate, since a learning rate that is too high is the most common cause of a diverging loss.',
+        'Gradient clipping, e.g. `tf.keras.optimizers.Adam(clipnorm=1.0)`, and normalized inputs also keep weight updates in check.',
+    ]
+
+
+class NaNInOutputError(BaseErrorMessage):
+    title = 'Critical: NaN (Not a number) in model output'
+    subtitle = 'Some values produced by your model are NaN, so the loss and every weight update that depends on them will be NaN as well.'
+    _so_query = {'q': '[keras] nan output'}
+    _md_solution = [
+        'Check the input data for NaN or infinite values, and try lowering the learning rate.',
+        'Operations such as `log`, `sqrt` or division in custom layers and losses can produce NaN for zero or negative inputs; add a small epsilon where needed.',
+    ]
+
+
+class OutputSaturatedError(BaseErrorMessage):
+    title = 'Warning: Saturated predictions'
+    subtitle = 'Most predictions put almost all of their probability on one class, yet many of them are wrong. The model is overconfident, and saturated softmax outputs pass very small gradients back.'
+    _so_query = {'q': '[keras] softmax saturation'}
+    _md_solution = [
+        'Make sure inputs are normalized and the learning rate is not too high, since both can blow up the logits.',
+        'Label smoothing, e.g. `tf.keras.losses.CategoricalCrossentropy(label_smoothing=0.1)`, or weight regularization can keep the logits in a reasonable range.',
+    ]
+
+
+class PredictionCollapseError(BaseErrorMessage):
+    title = 'Warning: Predictions collapsed to one class'
+    subtitle = 'The model predicts the same class for nearly every training example. This often means the model is only learning the most common label.'
+    _so_query = {'q': '[keras] model predicts same class'}
+    _md_solution = [
+        'Check whether the training labels are heavily imbalanced, and if so use `class_weight` in `model.fit` or resample the data.',
+        'Also check that the labels line up with the inputs after any shuffling or preprocessing.',
+    ]
+
+
+class ExplodingGradientsError(BaseErrorMessage):
+    title = 'Critical: Exploding gradients'
+    subtitle = 'The gradients of some layers are very large or not finite. Weight updates this large make training unstable and often end in a NaN loss.'
+    _so_query = {'q': '[keras] exploding gradients'}
+    _docs_url = 'https://www.tensorflow.org/api_docs/python/tf/keras/optimizers/Optimizer'
+    _md_solution = [
+        'Lower the learning rate, or clip gradients by passing `clipnorm` or `clipvalue` to your optimizer, e.g. `tf.keras.optimizers.Adam(clipnorm=1.0)`.',
+        'Normalizing inputs and adding `BatchNormalization` layers also keeps gradients in a reasonable range.',
+    ]
+
+
+class VanishingGradientsError(BaseErrorMessage):
+    title = 'Warning: Vanishing gradients'
+    subtitle = 'Weight updates of some layers are tiny compared to the weights themselves, so those layers are barely learning. Update to weight ratios around 1e-3 are typical.'
+    _so_query = {'q': '[keras] vanishing gradients'}
+    _md_solution = [
+        'Use `relu`-like activations instead of `sigmoid` or `tanh` in deep stacks, and an initializer suited to them such as `he_normal`.',
+        'Adding `BatchNormalization` or residual connections, or raising the learning rate, can also help gradients reach early layers.',
+    ]
+
+
+class DeadReLUError(BaseErrorMessage):
+    title = 'Warning: Dead ReLU units'
+    subtitle = 'Most units of a ReLU layer output zero for every input. These units pass no gradient back, so they have stopped learning and are unlikely to recover.'
+    _so_query = {'q': '[keras] dying relu'}
+    _docs_url = 'https://www.tensorflow.org/api_docs/python/tf/keras/layers/LeakyReLU'
+    _md_solution = [
+        'A learning rate that is too high is a common cause, so try lowering it.',
+        'Alternatively, use `tf.keras.layers.LeakyReLU()` or `activation=\'elu\'`, which keep a small gradient for negative inputs.',
+    ]
+
+
+class SaturatedActivationError(BaseErrorMessage):
+    title = 'Warning: Saturated activations'
+    subtitle = 'Most outputs of a sigmoid or tanh layer sit at the flat ends of the function, where its gradient is nearly zero. This slows or stops learning in the layers before it.'
+    _so_query = {'q': '[keras] sigmoid saturation'}
+    _md_solution = [
+        'Normalize the layer inputs, e.g. with `BatchNormalization`, and use an initializer such as `glorot_uniform` to keep pre-activations small.',
+        'For hidden layers, `activation=\'relu\'` does not saturate for positive inputs.',
+    ]
+
+
+class ActivationGrowthError(BaseErrorMessage):
+    title = 'Warning: Activations growing every epoch'
+    subtitle = 'The average activation magnitude of a layer grew by more than 50% for several epochs in a row. Unbounded growth often comes before exploding gradients or a NaN loss.'
+    _so_query = {'q': '[keras] activations exploding'}
+    _md_solution = [
+        'Add weight regularization, e.g. `kernel_regularizer=tf.keras.regularizers.l2(1e-4)`, or `BatchNormalization` layers.',
+        'Lowering the learning rate can also keep weights from growing.',
+    ]
+
+
 class MissingActivationError(BaseErrorMessage):
     title = 'Critical: Missing activation functions'
     subtitle = 'The model has layers without nonlinear activation functions. This may limit the model\'s ability to learn since stacked `Dense` layers without activations will mathematically collapse to a single `Dense` layer.'
@@ -315,12 +465,21 @@ ERROR_KEYS = {
     'input_not_floating': InputNotFloatingError,
     'input_wrong_shape': InputWrongShapeError,
     'nan_input': NaNInInputError,
+    'nan_loss': NaNInLossError,
+    'nan_output': NaNInOutputError,
+    'output_saturated': OutputSaturatedError,
+    'prediction_collapse': PredictionCollapseError,
     'lr_high': LRHighError,
     'lr_low': LRLowError,
     'no_softmax': NoSoftmaxActivationError,
     'overfitting': OverfittingError,
     'overconfident_val': OverconfidentValAccuracy,
     'missing_activations': MissingActivationError,
+    'exploding_gradients': ExplodingGradientsError,
+    'vanishing_gradients': VanishingGradientsError,
+    'dead_relu': DeadReLUError,
+    'saturated_activations': SaturatedActivationError,
+    'activation_growth': ActivationGrowthError,
     'activation_final_layer': FinalLayerHasActivationError,
     'high_dropout_rate': HighDropoutError,
 }
@@ -13,4 +13,50 @@ def index_of_dict(l, k, v):
     for i, d in enumerate(l):
         if k in d and d[k] == v:
             return i
-    return None
\ No newline at end of file
+    return None
+
+
+def merge_ranges(ranges):
+    '''sorts [start, end] ranges, joining overlapping and adjacent ones'''
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def lttb(xs, ys, threshold):
+    '''Downsamples a line to threshold points with Largest-Triangle-Three-Buckets.
+
+    Keeps the first and last points, and from each bucket in between the
+    point making the largest triangle with the last point kept and the
+    next bucket's average, which preserves peaks and trends.
+    '''
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return xs, ys
+
+    sampled_x, sampled_y = [xs[0]], [ys[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_bucket = range(end, min(int((i + 2) * every) + 1, n)) or range(n - 1, n)
+        avg_x = sum(xs[j] for j in next_bucket) / len(next_bucket)
+        avg_y = sum(ys[j] for j in next_bucket) / len(next_bucket)
+
+        best, best_area = start, -1.
+        for j in range(start, end):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > best_area:
+                best, best_area = j, area
+        sampled_x.append(xs[best])
+        sampled_y.append(ys[best])
+        a = best
+
+    sampled_x.append(xs[-1])
+    sampled_y.append(ys[-1])
+    return sampled_x, sampled_y
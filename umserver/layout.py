@@ -4,7 +4,7 @@ import dash_core_components as dcc
 import dash_html_components as html
 
 from umserver import app
-from umserver.models import get_training_sessions
+from umserver.errors import ERROR_KEYS
 
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
@@ -62,6 +62,12 @@ app.layout = html.Div([
                     'layout': {'title': 'Accuracy over Epochs'},
                 },
             ),
+            dcc.Graph(
+                id='graph_overhead',
+                figure={
+                    'layout': {'title': 'Umlaut Overhead over Epochs'},
+                },
+            ),
         ],
         className='five columns',
     ),
@@ -69,16 +75,23 @@ app.layout = html.Div([
             html.H3('Error Messages', style={'display': 'inline-block'}),
             html.Button(id='btn-clear-annotations', children='Clear Annotations', style={'display': 'inline-block', 'float': 'right'}),
             html.Hr(),
-            html.Div(id='errors-list'),
+            html.Div(
+                # a slot per error type, filled in as errors are reported
+                [html.P('No errors found for this session.', id='errors-empty')] + [
+                    html.Div(id={'type': 'error-slot', 'index': error_id}, style={'display': 'none'})
+                    for error_id in ERROR_KEYS
+                ],
+                id='errors-list',
+                style={'display': 'flex', 'flexDirection': 'column'},
+            ),
         ],
         className='six columns',
     ),
-    dcc.Interval(
-	id='interval-component',
-	interval=10*1000, # in milliseconds
-	n_intervals=0,
-    ),
-    dcc.Store(id='metrics-cache', storage_type='memory'),
+    # clicked by assets/live.js whenever the session receives data
+    html.Button(id='live-update', style={'display': 'none'}),
+    dcc.Store(id='metrics-version', storage_type='memory'),
+    dcc.Store(id='errors-delta', storage_type='memory'),
     dcc.Store(id='errors-cache', storage_type='memory'),
     dcc.Store(id='annotations-cache', storage_type='memory'),
+    dcc.Store(id='errors-rendered', storage_type='memory'),
 ])
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import threading
+
+
+class SessionNotifier:
+    '''Wakes up the streams watching a session when it receives data.
+
+    Ingest routes call notify with the session's new sequence number, and
+    each stream waits for a number newer than the last one it sent. Only
+    sessions with someone watching hold a condition.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}  # session id -> [condition, latest seq, watchers]
+
+    def notify(self, sess_id, seq):
+        with self._lock:
+            entry = self._sessions.get(sess_id)
+        if entry is None:
+            return  # nobody is watching
+        with entry[0]:
+            entry[1] = max(entry[1], seq)
+            entry[0].notify_all()
+
+    @contextlib.contextmanager
+    def watching(self, sess_id):
+        '''Registers a stream as watching a session for as long as the block runs.
+
+        Yields wait(seq, timeout), which returns the session's latest seq
+        once it is past seq, or None on timeout. The stream stays
+        registered between waits, so a notify while it is sending is
+        seen by its next wait instead of lost.
+        '''
+        with self._lock:
+            entry = self._sessions.setdefault(sess_id, [threading.Condition(), 0, 0])
+            entry[2] += 1
+
+        def wait(seq, timeout):
+            with entry[0]:
+                entry[0].wait_for(lambda: entry[1] > seq, timeout)
+                return entry[1] if entry[1] > seq else None
+
+        try:
+            yield wait
+        finally:
+            with self._lock:
+                entry[2] -= 1
+                if not entry[2]:
+                    self._sessions.pop(sess_id, None)
+
+
+notifier = SessionNotifier()
@@ -1,18 +1,445 @@
+import math
+import re
+from bson import ObjectId
+from datetime import datetime as dt
+from pymongo import ASCENDING
+from pymongo import DESCENDING
 from pymongo import MongoClient
+from pymongo import ReturnDocument
+from pymongo import UpdateOne
+
+from umserver.errors import epochs_to_ranges
+from umserver.helpers import lttb
+from umserver.helpers import merge_ranges
 
 client = MongoClient('localhost', 27017)
 db = client['umlaut']
 
 
-def get_training_sessions():
-    '''query mongodb for all sessions'''
-    sessions = []
-    for sess in db.sessions.find():
-        sessions.append({
-            'label': sess['name'],
-            'value': str(sess['_id']),
-        })
-    return sessions[::-1]
+def ensure_indexes():
+    '''creates the indexes umserver queries by. a no-op when they exist.'''
+    db.sessions.create_index([('name', ASCENDING)])
+    # with _id, so sessions updated at the same time page in a fixed order
+    db.sessions.create_index([('modify_timestamp', DESCENDING), ('_id', DESCENDING)])
+    db.plots.create_index([('session_id', ASCENDING), ('name', ASCENDING)])
+    db.errors.create_index([('session_id', ASCENDING), ('error_id_str', ASCENDING)])
+    db.plot_buckets.create_index([
+        ('session_id', ASCENDING),
+        ('plot', ASCENDING),
+        ('stream', ASCENDING),
+        ('first_x', ASCENDING),
+    ])
+    db.plot_levels.create_index([
+        ('session_id', ASCENDING),
+        ('plot', ASCENDING),
+        ('stream', ASCENDING),
+        ('span', ASCENDING),
+        ('slot', ASCENDING),
+    ], unique=True)
+    db.plot_levels.create_index([('session_id', ASCENDING), ('span', ASCENDING), ('first_x', ASCENDING)])
+    # delta reads of the errors changed after a sequence number
+    db.errors.create_index([('session_id', ASCENDING), ('seq', ASCENDING)])
+
+
+def allocate_session_name(base_name):
+    '''Returns base_name, or base_name_{n} if base_name was already handed out.
+
+    A counter document per base name hands out suffixes with $inc, so
+    allocation is one round trip and concurrent runs never get the same
+    name. A base name first seen without a counter is seeded once from the
+    sessions already named after it, so older databases carry on from
+    their highest suffix.
+    '''
+    counter = db.session_name_counters.find_one_and_update(
+        {'_id': base_name},
+        {'$inc': {'seq': 1}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if counter is None:
+        _seed_session_name_counter(base_name)
+        counter = db.session_name_counters.find_one_and_update(
+            {'_id': base_name},
+            {'$inc': {'seq': 1}},
+            return_document=ReturnDocument.AFTER,
+        )
+    # seq counts names handed out, the first one is the bare base name
+    seq = counter['seq']
+    return base_name if seq == 1 else f'{base_name}_{seq - 1}'
+
+
+def create_uniquely_named_session(base_name):
+    '''Makes a session named base_name, or base_name_{n}, and returns its id.
+
+    A name from allocate_session_name may still be taken by a session
+    made under that exact name, e.g. a run named exp_1, so a session is
+    only ever inserted, never reused, and the next name is tried until
+    one is free.
+    '''
+    while True:
+        name = allocate_session_name(base_name)
+        result = db.sessions.update_one(
+            {'name': name},
+            {'$setOnInsert': {
+                'name': name,
+                'modify_timestamp': dt.now().isoformat(),
+            }},
+            upsert=True,
+        )
+        if result.upserted_id is not None:
+            return result.upserted_id
+
+
+def _seed_session_name_counter(base_name):
+    # anchored at the start, so the name index is used
+    pattern = '^' + re.escape(base_name) + r'(?:_(\d+))?$'
+    seed = 0
+    for sess in db.sessions.find({'name': {'$regex': pattern}}, projection={'name': 1}):
+        suffix = re.match(pattern, sess['name'])[1]
+        seed = max(seed, int(suffix) + 1 if suffix else 1)
+    # $max, so a racing seed or allocation is never moved backwards
+    db.session_name_counters.update_one(
+        {'_id': base_name},
+        {'$max': {'seq': seed}},
+        upsert=True,
+    )
+
+
+# points per plot bucket. a bucket is full once it holds this many, and
+# the next append starts a new one.
+BUCKET_SIZE = 500
+
+
+def reserve_session_seq(sess_id):
+    '''Takes a session's next sequence number for a write, None if there is no such session.
+
+    Every ingest request takes the next number and stores it on the errors
+    it writes, so the dashboard can ask for only the errors changed after
+    the last number it saw, and versions its figures by it. The number is only published as the
+    session's seq by publish_session_seq once the writes are done, so a
+    dashboard never reads, or caches, a version which is half written. A
+    run's updates are sent one request at a time, so they are written in
+    sequence order.
+    '''
+    sess = db.sessions.find_one_and_update(
+        {'_id': sess_id},
+        # a pipeline, to carry on from seq on sessions stored before next_seq
+        [{'$set': {
+            'next_seq': {'$add': [{'$max': ['$next_seq', '$seq', 0]}, 1]},
+            # recently active sessions are listed first
+            'modify_timestamp': dt.now().isoformat(),
+        }}],
+        projection={'next_seq': 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    return sess['next_seq'] if sess else None
+
+
+def publish_session_seq(sess_id, seq):
+    '''makes seq, reserved by reserve_session_seq and written, the session's version.'''
+    db.sessions.update_one({'_id': sess_id}, {'$max': {'seq': seq}})
+
+
+def get_session_seq(sess_id):
+    '''the last sequence number published for a session, 0 before any.'''
+    sess = db.sessions.find_one(sess_id, projection={'seq': 1})
+    return sess.get('seq', 0) if sess else None
+
+
+def make_plot_bucket_op(sess_id, plot, stream, points):
+    '''Returns an upsert appending [x, y] points to a stream's newest bucket.
+
+    Buckets look like:
+    {
+        'session_id': ObjectId, 'plot': 'loss', 'stream': 'train',
+        'count': 3, 'points': [[0, 1.2], [1, 0.9], [2, 0.7]],
+        'first_x': 0, 'last_x': 2, 'min': 0.7, 'max': 1.2,
+        'first': 1.2, 'last': 0.7,
+    }
+
+    Only a bucket which isn't full
+    matches, so appends never touch older buckets, and the upsert starts
+    a new bucket when the newest is full. Points from one request go into
+    one bucket, so it may overshoot BUCKET_SIZE by that many.
+    '''
+    update = {
+        '$push': {'points': {'$each': [[x, y] for x, y in points]}},
+        '$inc': {'count': len(points)},
+        '$min': {'first_x': points[0][0]},
+        '$max': {'last_x': points[-1][0]},
+        '$set': {'last': points[-1][1]},
+        '$setOnInsert': {'first': points[0][1]},
+    }
+    finite = [y for _, y in points if isinstance(y, (int, float)) and math.isfinite(y)]
+    if finite:
+        # NaN sorts below every number in mongo, so keep it out of the summaries
+        update['$min']['min'] = min(finite)
+        update['$max']['max'] = max(finite)
+    return UpdateOne(
+        {
+            'session_id': sess_id,
+            'plot': plot,
+            'stream': stream,
+            'count': {'$lt': BUCKET_SIZE},
+        },
+        update,
+        upsert=True,
+    )
+
+
+# x widths of the downsampled levels kept next to the points, each
+# LEVEL_SPANS[0] times coarser than the one before
+LEVEL_SPANS = (16, 256, 4096, 65536)
+
+
+def make_plot_level_ops(sess_id, plot, stream, points):
+    '''Returns upserts folding [x, y] points into every downsampled level.
+
+    A level splits x into slots of span wide, and keeps one envelope per
+    slot:
+    {
+        'session_id': ObjectId, 'plot': 'loss', 'stream': 'train',
+        'span': 16, 'slot': 3, 'count': 16,
+        'first_x': 48, 'last_x': 63, 'min': 0.7, 'max': 1.2,
+        'first': 1.2, 'last': 0.7,
+    }
+
+    so an overview of any range reads a bounded number of documents. Points
+    are appended in increasing x, so each request touches the newest slot
+    or two of each level.
+    '''
+    slots = {}
+    for x, y in points:
+        for span in LEVEL_SPANS:
+            slots.setdefault((span, int(x // span)), []).append([x, y])
+    ops = []
+    for (span, slot), slot_points in slots.items():
+        update = {
+            '$inc': {'count': len(slot_points)},
+            '$min': {'first_x': slot_points[0][0]},
+            '$max': {'last_x': slot_points[-1][0]},
+            '$set': {'last': slot_points[-1][1]},
+            '$setOnInsert': {'first': slot_points[0][1]},
+        }
+        finite = [y for _, y in slot_points if isinstance(y, (int, float)) and math.isfinite(y)]
+        if finite:
+            # NaN sorts below every number in mongo, so keep it out of the envelope
+            update['$min']['min'] = min(finite)
+            update['$max']['max'] = max(finite)
+        ops.append(UpdateOne(
+            {
+                'session_id': sess_id,
+                'plot': plot,
+                'stream': stream,
+                'span': span,
+                'slot': slot,
+            },
+            update,
+            upsert=True,
+        ))
+    return ops
+
+
+def get_session_streams(sess_id, x_min=None, x_max=None, max_points=None):
+    '''Reads a session's plot streams, optionally only points in [x_min, x_max].
+
+    Returns {plot: {stream: [[x, ...], [y, ...]]}}. Only the buckets
+    overlapping the range are fetched. Sessions stored before bucketing
+    are read from their single plots document instead.
+
+    With max_points, a stream with more points than that in the range is
+    drawn from the finest downsampled level which fits in max_points,
+    reading about max_points / 4 level documents a stream however long
+    the run. A zoomed range with fewer points is read in full resolution.
+    '''
+    query = {'session_id': sess_id}
+    if x_min is not None:
+        query['last_x'] = {'$gte': x_min}
+    if x_max is not None:
+        query['first_x'] = {'$lte': x_max}
+
+    points = {}
+    if max_points is not None:
+        points = _read_levels(sess_id, x_min, x_max, max_points)
+        if points:
+            # only the streams short enough to send in full are read as points
+            query['$nor'] = [
+                {'plot': plot, 'stream': stream}
+                for plot in points for stream in points[plot]
+            ]
+
+    buckets = db.plot_buckets.find(
+        query,
+        projection={'_id': 0, 'plot': 1, 'stream': 1, 'points': 1},
+    ).sort([('first_x', ASCENDING)])
+    for bucket in buckets:
+        stream = points.setdefault(bucket['plot'], {}).setdefault(bucket['stream'], [])
+        stream.extend(bucket['points'])
+    if not points:
+        # stored before bucketing, and short
+        for plot in db.plots.find({'session_id': sess_id}):
+            points[plot['name']] = plot['streams']
+
+    streams = {}
+    for plot, plot_streams in points.items():
+        for k, stream in plot_streams.items():
+            stream = _points_in_range(stream, x_min, x_max)
+            if not stream:
+                continue
+            # [[x, y], ...] to [[x, ...], [y, ...]]. older buckets also
+            # stored the write's seq on each point, which is dropped
+            xs, ys = [list(axis) for axis in zip(*stream)][:2]
+            if max_points is not None:
+                xs, ys = lttb(xs, ys, max_points)
+            streams.setdefault(plot, {})[k] = [xs, ys]
+    return streams
+
+
+def _read_levels(sess_id, x_min, x_max, max_points):
+    '''Reads the streams with more than max_points points in range from a level.
+
+    Without a full range, the coarsest level is read first, a few
+    documents per stream, to find the x extent. The finest level whose
+    slots in the range fit in max_points, at up to 4 points a slot, is
+    then read. Its slot counts tell how many points each stream has in
+    range, give or take the two slots on its edges, and only the streams
+    with more than max_points are drawn from it. The rest are read in
+    full resolution.
+    '''
+    query = {'session_id': sess_id}
+    if x_min is not None:
+        query['last_x'] = {'$gte': x_min}
+    if x_max is not None:
+        query['first_x'] = {'$lte': x_max}
+    low, high = x_min, x_max
+    if low is None or high is None:
+        coarsest = list(db.plot_levels.find(
+            dict(query, span=LEVEL_SPANS[-1]),
+            projection={'_id': 0, 'first_x': 1, 'last_x': 1},
+        ))
+        if not coarsest:
+            return {}
+        if low is None:
+            low = min(doc['first_x'] for doc in coarsest)
+        if high is None:
+            high = max(doc['last_x'] for doc in coarsest)
+
+    span = next(
+        (span for span in LEVEL_SPANS if 4 * ((high - low) // span + 1) <= max_points),
+        LEVEL_SPANS[-1],
+    )
+    docs = db.plot_levels.find(
+        dict(query, span=span),
+        projection={'_id': 0, 'session_id': 0},
+    ).sort([('slot', ASCENDING)])
+    counts, slots = {}, {}
+    for doc in docs:
+        key = (doc['plot'], doc['stream'])
+        counts[key] = counts.get(key, 0) + doc['count']
+        slots.setdefault(key, []).append(doc)
+
+    points = {}
+    for (plot, stream), count in counts.items():
+        if count <= max_points:
+            continue
+        for doc in slots[(plot, stream)]:
+            points.setdefault(plot, {}).setdefault(stream, []).extend(_envelope_points(doc))
+    return points
+
+
+def _envelope_points(doc):
+    '''a slot's envelope, its first and last points and its min and max between.'''
+    mid_x = (doc['first_x'] + doc['last_x']) / 2
+    points = [[doc['first_x'], doc['first']]]
+    if 'min' in doc:
+        points += [[mid_x, doc['min']], [mid_x, doc['max']]]
+    points.append([doc['last_x'], doc['last']])
+    return points
+
+
+def _points_in_range(points, x_min, x_max):
+    return [
+        p for p in points
+        if (x_min is None or p[0] >= x_min) and (x_max is None or p[0] <= x_max)
+    ]
+
+
+def get_session_errors(sess_id, since=None):
+    '''Reads a session's errors, latest first, or only those changed after since.
+
+    Returns (errors, seq), where seq is the newest sequence number read.
+    Epochs are returned as sorted [start, end] epoch_ranges, also for
+    errors stored as an epochs list before ranges.
+    '''
+    query = {'session_id': sess_id}
+    if since is not None:
+        query['seq'] = {'$gt': since}
+    errors = list(db.errors.find(
+        query,
+        # omit object ids from results, not json friendly
+        {'_id': 0, 'session_id': 0},
+    ))
+    for error in errors:
+        epochs = error.pop('epochs', None)
+        ranges = error.get('epoch_ranges')
+        if epochs is not None or ranges is not None:
+            error['epoch_ranges'] = merge_ranges((ranges or []) + epochs_to_ranges(epochs or []))
+        else:
+            error['epoch_ranges'] = None
+    # sort by epoch descending (latest first)
+    errors.sort(key=lambda e: e['epoch_ranges'][-1][1] if e['epoch_ranges'] else -1, reverse=True)
+    seq = max([since or 0] + [e.get('seq', 0) for e in errors])
+    return errors, seq
+
+
+def search_sessions(prefix='', limit=20, cursor=None):
+    '''Finds sessions whose name starts with prefix, most recently modified first.
+
+    Returns (sessions, next_cursor), where sessions are dropdown options
+    and next_cursor is passed as cursor to get the following page, None
+    after the last one. Prefixes are matched on the name index, and only
+    the fields the options need are read.
+    '''
+    query = {}
+    if prefix:
+        query['name'] = {'$regex': '^' + re.escape(prefix)}
+    if cursor:
+        # everything after the last session of the previous page
+        timestamp, sess_id = cursor.rsplit('|', 1)
+        query['$or'] = [
+            {'modify_timestamp': {'$lt': timestamp}},
+            {'modify_timestamp': timestamp, '_id': {'$lt': ObjectId(sess_id)}},
+        ]
+    found = list(db.sessions.find(
+        query,
+        projection={'name': 1, 'modify_timestamp': 1},
+    ).sort([('modify_timestamp', DESCENDING), ('_id', DESCENDING)]).limit(limit + 1))
+
+    sessions = [{'label': s['name'], 'value': str(s['_id'])} for s in found[:limit]]
+    next_cursor = None
+    if len(found) > limit:
+        last = found[limit - 1]
+        next_cursor = f'{last.get("modify_timestamp", "")}|{last["_id"]}'
+    return sessions, next_cursor
+
+
+def get_session_option(sess_id):
+    '''the dropdown option for one session, None if there is no such session'''
+    sess = db.sessions.find_one(sess_id, projection={'name': 1})
+    return {'label': sess['name'], 'value': str(sess['_id'])} if sess else None
 
 
-__all__ = ['db']
+__all__ = [
+    'db',
+    'allocate_session_name',
+    'create_uniquely_named_session',
+    'ensure_indexes',
+    'get_session_errors',
+    'get_session_seq',
+    'get_session_option',
+    'get_session_streams',
+    'make_plot_bucket_op',
+    'make_plot_level_ops',
+    'publish_session_seq',
+    'reserve_session_seq',
+    'search_sessions',
+]